@@ -0,0 +1,204 @@
+# =================================================================
+# answer_cache.py
+# Response cache in front of the QA chain. Answers are keyed on the
+# normalised query plus the intent that produced them; a semantic tier
+# reuses an answer when a new query's embedding is close enough to a
+# cached one. Entries expire by TTL, are evicted LRU-first past the
+# entry or memory cap, and are dropped whenever faiss_index is reloaded
+# (ChatbotEngine.reload_index calls invalidate()).
+#
+# Normalised query vectors live in one preallocated matrix with a row
+# per entry slot, so a semantic lookup is a single matrix-vector product.
+# =================================================================
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from intent import normalize_text
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 1000))
+ANSWER_CACHE_MAX_MB = float(os.environ.get("ANSWER_CACHE_MAX_MB", 64))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 6 * 3600))          # Seconds
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95)) # Cosine threshold, >= 1 disables the semantic tier
+
+
+class _Entry:
+    __slots__ = ("intent", "answer", "slot", "created", "size")
+
+    def __init__(self, intent, answer, slot, size):
+        self.intent = intent
+        self.answer = answer
+        self.slot = slot  # Row of the entry's vector in the matrix, or None
+        self.created = time.monotonic()
+        self.size = size
+
+
+class AnswerCache:
+    """Exact + semantic answer cache with TTL/LRU eviction and a memory cap."""
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, max_mb: float = ANSWER_CACHE_MAX_MB,
+                 ttl: float = ANSWER_CACHE_TTL, similarity: float = ANSWER_CACHE_SIMILARITY,
+                 enabled: bool = ANSWER_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.similarity = similarity
+        self.enabled = enabled
+        self._entries = OrderedDict()  # (intent, normalised query) -> _Entry, oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._matrix = None                                      # max_entries x dim, allocated on the first vector
+        self._slot_keys = [None] * max_entries                   # slot -> entry key
+        self._slot_intents = np.full(max_entries, -1, np.int32)  # slot -> intent code, -1 when free
+        self._intent_codes = {}
+        self._free_slots = []
+        self._high_slot = 0                                      # Slots at or above this were never used
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # -----------------------------------------------------------------
+    # Public API
+    # -----------------------------------------------------------------
+    def peek(self, query: str, intent: str):
+        """Exact-tier lookup made before retrieval. A miss is not counted:
+        the lookup is finished by get() once the query vector is known."""
+        return self._lookup(query, intent, None, count_miss=False)
+
+    def get(self, query: str, intent: str, vector=None):
+        """Returns a cached answer, or None, counting the miss.
+
+        Without `vector` (the query was answered from BM25 alone) only the
+        exact tier is consulted; with it, the semantic tier is searched too.
+        """
+        return self._lookup(query, intent, vector, count_miss=True)
+
+    def put(self, query: str, intent: str, answer: str, vector=None):
+        """Stores an answer, evicting old entries past the caps."""
+        if not self.enabled or not answer:
+            return
+        key = (intent, normalize_text(query))
+        vector = self._normalize(vector) if vector is not None and self.similarity < 1 else None
+        size = len(answer.encode("utf-8")) + len(key[1].encode("utf-8"))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            # Make room first, so a slot is free for the new vector
+            while self._entries and (len(self._entries) >= self.max_entries or self._bytes + size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            slot = self._store_vector(key, intent, vector) if vector is not None else None
+            self._entries[key] = _Entry(intent, answer, slot, size)
+            self._bytes += size
+
+    def invalidate(self):
+        """Drops every cached answer."""
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _lookup(self, query: str, intent: str, vector, count_miss: bool):
+        if not self.enabled:
+            return None
+        key = (intent, normalize_text(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.answer
+
+            match = self._semantic_lookup(intent, vector) if vector is not None else None
+            if match is not None and self._expired(self._entries[match]):
+                self._remove(match)
+                match = None
+            if match is not None:
+                self._entries.move_to_end(match)
+                self.hits += 1
+                self.semantic_hits += 1
+                return self._entries[match].answer
+            if count_miss:
+                self.misses += 1
+            return None
+
+    # -----------------------------------------------------------------
+    # Internals (called with the lock held)
+    # -----------------------------------------------------------------
+    def _expired(self, entry) -> bool:
+        return time.monotonic() - entry.created > self.ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        if entry.slot is not None:
+            self._slot_keys[entry.slot] = None
+            self._slot_intents[entry.slot] = -1
+            self._free_slots.append(entry.slot)
+
+    def _clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self._slot_keys = [None] * self.max_entries
+        self._slot_intents.fill(-1)
+        self._free_slots = []
+        self._high_slot = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _store_vector(self, key, intent, vector):
+        """Writes the vector into a free matrix row and returns the row, or None."""
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        elif self._matrix.shape[1] != vector.shape[0]:
+            return None
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        elif self._high_slot < self.max_entries:
+            slot = self._high_slot
+            self._high_slot += 1
+        else:
+            return None
+        self._matrix[slot] = vector
+        self._slot_keys[slot] = key
+        self._slot_intents[slot] = self._intent_codes.setdefault(intent, len(self._intent_codes))
+        return slot
+
+    def _semantic_lookup(self, intent, vector):
+        if self.similarity >= 1 or self._matrix is None or intent not in self._intent_codes:
+            return None
+        query = self._normalize(vector)
+        if query is None or query.shape[0] != self._matrix.shape[1]:
+            return None
+        used = self._high_slot
+        if not used:
+            return None
+        scores = self._matrix[:used] @ query
+        scores[self._slot_intents[:used] != self._intent_codes[intent]] = -np.inf
+        best = int(np.argmax(scores))
+        return self._slot_keys[best] if scores[best] >= self.similarity else None
@@ -0,0 +1,373 @@
+# =================================================================
+# bench.py
+# Offline load test for the /chat/ webhook. Replays recorded or
+# synthetic Goftino new_message payloads against main.app at a fixed
+# concurrency. The Goftino API and the AvalAI (OpenAI-compatible) chat
+# and embedding endpoints are replaced by local stub servers with
+# configurable latency distributions, so no network access or API key
+# is needed. Reports webhook latency, end-to-end reply latency and
+# throughput.
+#
+# Latency specs: "const:0.5", "uniform:0.2,1.0", "normal:0.8,0.2" or
+# "lognormal:0.8,0.5" (median seconds, sigma).
+#
+# Usage:
+#   python bench.py --messages 200 --concurrency 20 > bench_output.txt
+#   python bench.py --payloads recorded.jsonl --llm-latency lognormal:1.2,0.4 --json
+# =================================================================
+import argparse
+import asyncio
+import base64
+import csv
+import hashlib
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+BENCH_HOST = "127.0.0.1"
+EMBEDDING_DIM = 3072  # Must match the index under test (text-embedding-3-large)
+
+
+# =================================================================
+# 1. LATENCY DISTRIBUTIONS
+# =================================================================
+def parse_latency(spec: str):
+    """Returns a function that draws one delay in seconds from a latency spec."""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "const":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(np.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency spec: {spec}")
+
+
+def percentile(values, q: float) -> float:
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+# =================================================================
+# 2. STUB SERVERS
+# Goftino and OpenAI-compatible endpoints in one FastAPI app, served
+# from a background thread so stub latency never blocks the app.
+# =================================================================
+class Recorder:
+    """Goftino calls by chat_id, plus stub request counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = defaultdict(list)  # chat_id -> [(endpoint, perf_counter time)]
+        self.counts = defaultdict(int)
+
+    def add(self, endpoint: str, chat_id: str = None):
+        with self.lock:
+            self.counts[endpoint] += 1
+            if chat_id is not None:
+                self.events[chat_id].append((endpoint, time.perf_counter()))
+
+
+def stub_app(recorder: Recorder, args):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    app = FastAPI()
+    goftino_latency = parse_latency(args.goftino_latency)
+    llm_latency = parse_latency(args.llm_latency)
+    token_latency = parse_latency(args.token_latency)
+    embed_latency = parse_latency(args.embed_latency)
+    intents, weights = zip(*[(name, float(w)) for name, w in (p.split("=") for p in args.intent_mix.split(","))])
+    answer_words = ["پاسخ", "آزمایشی", "برای", "سنجش", "کارایی", "ربات", "مدرسه", "ایران", "استرالیا."]
+
+    async def goftino(endpoint: str, request: Request):
+        body = await request.json()
+        await asyncio.sleep(goftino_latency())
+        recorder.add(endpoint, body.get("chat_id"))
+        return {"status": "success"}
+
+    @app.post("/goftino/send_message")
+    async def send_message(request: Request):
+        return await goftino("send_message", request)
+
+    @app.post("/goftino/operator_typing")
+    async def operator_typing(request: Request):
+        return await goftino("operator_typing", request)
+
+    @app.post("/goftino/transfer_chat")
+    async def transfer_chat(request: Request):
+        return await goftino("transfer_chat", request)
+
+    @app.post("/openai/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(embed_latency())
+        recorder.add("embeddings")
+        data = []
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.sha256(str(text).encode("utf-8")).digest()[:4], "little")
+            vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIM).astype(np.float32)
+            vector /= np.linalg.norm(vector)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        return {"object": "list", "data": data, "model": body.get("model"),
+                "usage": {"prompt_tokens": 8 * len(texts), "total_tokens": 8 * len(texts)}}
+
+    @app.post("/openai/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = " ".join(str(m.get("content", "")) for m in body["messages"])
+        prompt_tokens = len(prompt) // 3
+        if "intent classifier" in prompt:
+            recorder.add("llm_intent")
+            words = [random.choices(intents, weights)[0]]
+        else:
+            recorder.add("llm_answer")
+            words = [random.choice(answer_words) for _ in range(args.answer_words)]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        created = int(time.time())
+        await asyncio.sleep(llm_latency())
+
+        if not body.get("stream"):
+            await asyncio.sleep(sum(token_latency() for _ in words))
+            return JSONResponse({
+                "id": "bench", "object": "chat.completion", "created": created, "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        async def events():
+            def chunk(delta, finish=None, extra=None):
+                payload = {"id": "bench", "object": "chat.completion.chunk", "created": created,
+                           "model": body["model"],
+                           "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if delta is not None else []}
+                payload.update(extra or {})
+                return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+            yield chunk({"role": "assistant", "content": ""})
+            for word in words:
+                await asyncio.sleep(token_latency())
+                yield chunk({"content": word + " "})
+            yield chunk({}, "stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield chunk(None, extra={"usage": usage})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((BENCH_HOST, 0))
+        return s.getsockname()[1]
+
+
+def start_stubs(recorder: Recorder, args) -> int:
+    """Serves the stub app on a background thread and returns its port."""
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(stub_app(recorder, args), host=BENCH_HOST, port=port,
+                                           log_level="warning", access_log=False))
+    threading.Thread(target=server.run, name="bench-stubs", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return port
+
+
+# =================================================================
+# 3. PAYLOADS
+# =================================================================
+def synthetic_payloads(count: int, source: str = "data/intents.csv"):
+    """new_message payloads built from the labelled intent examples."""
+    with open(source, encoding="utf-8") as f:
+        texts = [row["text"] for row in csv.DictReader(f)]
+    return [{
+        "event": "new_message",
+        "data": {"chat_id": "", "message_id": f"bench-{i}", "content": random.choice(texts), "type": "text",
+                 "operator_id": None, "sender": {"from": "user"}},
+    } for i in range(count)]
+
+
+def load_payloads(path: str, count: int):
+    """Recorded webhook bodies, one JSON object per line, cycled up to `count`."""
+    with open(path, encoding="utf-8") as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    return [json.loads(json.dumps(recorded[i % len(recorded)])) for i in range(count)]
+
+
+# =================================================================
+# 4. LOAD GENERATOR
+# =================================================================
+async def replay(app_url: str, payloads, concurrency: int, rate: float):
+    """Posts every payload, at most `concurrency` at a time. Returns [(chat_id, start, webhook seconds, status)]."""
+    import httpx
+
+    results = []
+    queue = asyncio.Queue()
+    for item in enumerate(payloads):
+        queue.put_nowait(item)
+    begin = time.perf_counter()
+
+    async def client_worker(client):
+        while not queue.empty():
+            i, payload = queue.get_nowait()
+            if rate:
+                # Open loop: message i is due at begin + i / rate
+                await asyncio.sleep(max(0.0, begin + i / rate - time.perf_counter()))
+            start = time.perf_counter()
+            response = await client.post(f"{app_url}/chat/", json=payload)
+            results.append((payload["data"]["chat_id"], start, time.perf_counter() - start, response.status_code))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        await asyncio.gather(*(client_worker(client) for _ in range(concurrency)))
+    return results
+
+
+async def run(args):
+    recorder = Recorder()
+    stub_port = start_stubs(recorder, args)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+
+    # Point the app at the stubs and keep its caches and stores out of the real ones.
+    os.environ.update({
+        "GOFTINO_API_BASE": f"http://{BENCH_HOST}:{stub_port}/goftino",
+        "AVALAI_BASE_URL": f"http://{BENCH_HOST}:{stub_port}/openai",
+        "EMBEDDING_CHECK_CTX_LENGTH": "0",
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache"),
+        "ANSWER_CACHE_ENABLED": "1" if args.answer_cache else "0",
+        "COMPLAINT_PATH": os.path.join(workdir, "complaints.db"),
+        "SESSION_PATH": os.path.join(workdir, "sessions.db"),
+        "INDEX_RELOAD_INTERVAL": "0",
+        "GOFTINO_TYPING_DEBOUNCE": "0",
+    })
+    for name, value in args.env:
+        os.environ[name] = value
+
+    import logging
+    import uvicorn
+    import main
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    main.engine.vector_store_path = args.index
+
+    app_port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host=BENCH_HOST, port=app_port,
+                                           log_level="warning", access_log=False))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    await asyncio.to_thread(main.engine.load)
+    if not main.engine.ready:
+        raise SystemExit(f"Chatbot engine failed to load: {main.engine.error}")
+
+    payloads = load_payloads(args.payloads, args.messages) if args.payloads else synthetic_payloads(args.messages)
+    for i, payload in enumerate(payloads):
+        # Unique chats, so every Goftino call maps back to one message
+        payload["data"]["chat_id"] = f"bench-chat-{i}"
+
+    start = time.perf_counter()
+    results = await replay(f"http://{BENCH_HOST}:{app_port}", payloads, args.concurrency, args.rate)
+    webhook_done = time.perf_counter()
+    await main.dispatcher.queue.join()
+    await asyncio.sleep(0.2)  # Let trailing typing-off calls land
+    finished = time.perf_counter()
+
+    server.should_exit = True
+    await serving
+    return report(results, recorder, main, start, webhook_done, finished, args)
+
+
+# =================================================================
+# 5. REPORT
+# =================================================================
+def report(results, recorder, main, start, webhook_done, finished, args) -> dict:
+    webhook_ms = [r[2] * 1000 for r in results]
+    first_reply, last_reply = [], []
+    replied = 0
+    for chat_id, sent, _, _ in results:
+        replies = [t for endpoint, t in recorder.events.get(chat_id, []) if endpoint in ("send_message", "transfer_chat")]
+        if replies:
+            replied += 1
+            first_reply.append((replies[0] - sent) * 1000)
+            last_reply.append((replies[-1] - sent) * 1000)
+
+    def summary(values):
+        return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+                "max": max(values) if values else float("nan")}
+
+    result = {
+        "messages": len(results),
+        "concurrency": args.concurrency,
+        "errors": sum(1 for r in results if r[3] >= 400),
+        "replied": replied,
+        "shed": main.dispatcher.shed_count,
+        "webhook_ms": summary(webhook_ms),
+        "first_reply_ms": summary(first_reply),
+        "last_reply_ms": summary(last_reply),
+        "webhook_rps": len(results) / (webhook_done - start),
+        "reply_throughput": replied / (finished - start),
+        "wall_seconds": finished - start,
+        "stub_calls": dict(recorder.counts),
+        "tokens": main.engine.usage.stats(),
+    }
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return result
+
+    print(f"Messages: {result['messages']}  concurrency: {args.concurrency}  errors: {result['errors']}  "
+          f"replied: {replied}  shed: {result['shed']}  wall: {result['wall_seconds']:.2f}s")
+    print(f"{'latency (ms)':<16} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name in ("webhook_ms", "first_reply_ms", "last_reply_ms"):
+        s = result[name]
+        print(f"{name[:-3]:<16} {s['p50']:>9.1f} {s['p95']:>9.1f} {s['p99']:>9.1f} {s['max']:>9.1f}")
+    print(f"Throughput: {result['webhook_rps']:.1f} webhooks/s, {result['reply_throughput']:.2f} replies/s")
+    print("Stub calls: " + ", ".join(f"{k}={v}" for k, v in sorted(recorder.counts.items())))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the Goftino webhook.")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20, help="Webhook requests in flight")
+    parser.add_argument("--rate", type=float, default=0.0, help="Webhooks per second, 0 for as fast as possible")
+    parser.add_argument("--payloads", help="JSONL file of recorded webhook bodies (default: synthetic)")
+    parser.add_argument("--index", default="faiss_index")
+    parser.add_argument("--llm-latency", default="lognormal:0.8,0.4", help="Time to first token")
+    parser.add_argument("--token-latency", default="const:0.01", help="Delay per generated word")
+    parser.add_argument("--embed-latency", default="lognormal:0.15,0.3")
+    parser.add_argument("--goftino-latency", default="lognormal:0.05,0.3")
+    parser.add_argument("--intent-mix", default="faq=0.7,chitchat=0.2,unknown=0.1",
+                        help="Answers of the stub LLM intent classifier")
+    parser.add_argument("--answer-words", type=int, default=60)
+    parser.add_argument("--answer-cache", action="store_true", help="Keep the answer cache enabled")
+    parser.add_argument("--env", nargs=2, action="append", default=[], metavar=("NAME", "VALUE"),
+                        help="Extra environment for the app, e.g. --env CHATBOT_PIPELINE executor")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,27 +2,37 @@
 # chatbot.py
 # This file handles the chatbot's runtime logic, including
 # loading the pre-computed vector store and responding to queries.
+#
+# Everything lives on a ChatbotEngine. Importing this module is cheap:
+# the LLM / embedding clients, the FAISS index and the QA chain are
+# only created by engine.load(), which main.py runs in the background
+# at startup (warmup) and which the pipelines call on first use.
 # =================================================================
 
 # =================================================================
 # 1. IMPORTS
-# All necessary libraries for the Streamlit app.
+# The langchain / faiss imports are deferred to ChatbotEngine.load().
 # =================================================================
 import os
-import csv # Import the csv module
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_openai import ChatOpenAI
-from langchain.chains import RetrievalQA
-from langchain.schema import HumanMessage
+import asyncio
 import logging
+import threading
+import time
 import traceback
+from intent import IntentEngine, load_classifier, normalize_text
+from answer_cache import AnswerCache
+from context_builder import TokenUsage, build_context, load_token_encoding
+from lexical_index import HYBRID_FETCH_K, HYBRID_RETRIEVAL, LEXICAL_SKIP_EMBEDDING, LexicalIndex, reciprocal_rank_fusion
+from complaints import ComplaintSink, make_record
+from sessions import Session, SessionStore
+from streaming import TextSegmenter
+from metrics import MESSAGES, RESPONSE_SECONDS, span, timed
 
 # Import the API key from your config.py file
 from config import AVALAI_API_KEY
 
 # =================================================================
-# 2. CONFIGURATION AND INITIALIZATION
+# 2. CONFIGURATION
 # Make sure your API key is set correctly and base_url is specified.
 # All model and embedding initializations now use AvalAI's endpoint.
 # =================================================================
@@ -30,79 +40,18 @@ from config import AVALAI_API_KEY
 # Replace "your-avalai-api-key" with your actual AvalAI API key
 # or ensure it's set in your environment before running this script.
 
-# Define the base URL for AvalAI
-AVALAI_BASE_URL = "https://api.avalai.ir/v1"
-
-# Initialize qa_chain as None. It will be created later if data is available.
-qa_chain = None
-
-# Global variables to store user information and chatbot state
-user_name = None
-user_phone_number = None
-user_info_collected = False
-
-# Check if the API key is available
-if not AVALAI_API_KEY: # This check is now based on the imported variable
-    print("❌ Error: AVALAI_API_KEY not found in config.py.")
-    print("Please ensure config.py exists and AVALAI_API_KEY is set.")
-else:
-    print("AvalAI API key found. Initializing models and embeddings...")
-    try:
-        # Initialize ChatOpenAI for both general use and intent detection
-        llm = ChatOpenAI(
-            model="gpt-4o",
-            temperature=0.7,
-            api_key=AVALAI_API_KEY,
-            base_url=AVALAI_BASE_URL
-        )
-
-        # Initialize OpenAIEmbeddings, pointing to the AvalAI base_url
-        embeddings = OpenAIEmbeddings(
-            model="text-embedding-3-large",
-            api_key=AVALAI_API_KEY,
-            base_url=AVALAI_BASE_URL
-        )
+# Define the base URL for AvalAI (bench.py points it at a local stub)
+AVALAI_BASE_URL = os.environ.get("AVALAI_BASE_URL", "https://api.avalai.ir/v1")
+# Tokenize queries with tiktoken to split over-long ones; needs the encoding download
+EMBEDDING_CHECK_CTX_LENGTH = os.environ.get("EMBEDDING_CHECK_CTX_LENGTH", "1") == "1"
 
-        # =================================================================
-        # 3. LOAD VECTOR STORE AND SETUP RETRIEVER/QA CHAIN
-        # This section loads the pre-computed FAISS vector store.
-        # =================================================================
-        # print("Loading vectorstore...")
-        vector_store_path = "faiss_index" # This must match the path used in embedder.py
+VECTOR_STORE_PATH = "faiss_index" # This must match the path used in embedder.py
 
-        if os.path.exists(vector_store_path):
-            try:
-                # Load the local FAISS index
-                # allow_dangerous_deserialization=True is often needed for FAISS.load_local
-                vectorstore = FAISS.load_local(vector_store_path, embeddings, allow_dangerous_deserialization=True)
-                retriever = vectorstore.as_retriever()
-                # print(f"Vectorstore loaded successfully from {vector_store_path}.")
-
-                # Create the QA chain for handling FAQs
-                qa_chain = RetrievalQA.from_chain_type(
-                    llm=llm,
-                    chain_type="stuff",  # "stuff" is a common chain type for this purpose
-                    retriever=retriever
-                )
-                # print("QA chain created successfully.")
+# Ask for the visitor's name and phone number before answering (per chat, see sessions.py)
+SESSION_COLLECT_INFO = os.environ.get("SESSION_COLLECT_INFO", "0") == "1"
 
-            except Exception as e:
-                print(f"❌ Error loading vectorstore from {vector_store_path}: {e}")
-                print("Please ensure embedder.py has been run to create the FAISS index.")
-                retriever = None
-        else:
-            print(f"⚠️ Warning: Vectorstore not found at {vector_store_path}.")
-            print("Please run embedder.py first to create the FAISS index.")
-            retriever = None
-            qa_chain = None # Ensure qa_chain is None if vectorstore isn't loaded
-
-        # =================================================================
-        # 4. INTENT DETECTION FUNCTION
-        # This function uses the initialized LLM to classify user intent.
-        # =================================================================
-        def detect_intent(user_input: str) -> str:
-            """Classifies the intent of the user input."""
-            prompt = f"""
+# Prompt templates shared by the sync and async pipelines
+INTENT_PROMPT = """
         You are an intent classifier. Classify the intent of the user input below into one of these:
         - greeting
         - faq
@@ -110,126 +59,763 @@ else:
         - visitor_info
         - chitchat
         - unrelated to the iran-australia institute
-        - unknown 
+        - unknown
         avoid the unknown category as much as possible
         Input: "{user_input}"
         Intent:"""
-            response = llm.invoke([HumanMessage(content=prompt)])
-            intent_text = response.content.strip()
-            # Clean up the intent text to get just the category name
-            if ":" in intent_text:
-                return intent_text.split(":")[-1].strip()
-            else:
-                return intent_text
-
-        # =================================================================
-        # 5. INTENT HANDLERS
-        # These functions define the specific actions for each detected intent.
-        # All responses should be comprehensive and in Persian.
-        # =================================================================
-        def handle_greeting(query: str):
-            """Handles greeting intent, potentially enhanced with info from QA chain, in Persian."""
-            base_response = "سلام، من ربات مجموعه آموزش زبان ایران استرالیا هستم، چجوری میتونم کمکتون کنم؟"
-            if qa_chain is None:
-                return base_response + "\n\n(توجه: پایگاه دانش برای ارائه اطلاعات بیشتر در دسترس نیست.)"
+# Knowledge base answers: the system message is the same for every request of an
+# intent, so providers can cache it as a prompt prefix; the per-request context
+# and question go in the user message after it.
+KB_SYSTEM_PROMPT = """Use the following pieces of context to answer the user's question. If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+{instructions}"""
+KB_USER_PROMPT = """Context:
+{context}
+
+{history}Question: {query}"""
+GREETING_INSTRUCTIONS = "لطفا جواب بده و تو هم سلام و احوالپرسی کن، حواست باشه که تو ربات مجموعه آموزشی ایران استرالیا هستی و بجز این مدرسه نباید تبلیغ هیچ جای دیگه ای رو بکنی."
+FAQ_INSTRUCTIONS = "لطفاً به این سوال به طور کامل، و با جزئیات کافی به فارسی پاسخ دهید."
+VISITOR_INFO_INSTRUCTIONS = "سعی کن در قامت یک ربات فروش محصول کاربر را قانع کنی که یادگیری زبان کار مفیدی است و باید هرچه زودتر شروع کند و کجا بهتر از مدرسه ایران استرالیا، البته قبل از هر چیز اول جواب سوال پرسیده شده رو بده، مثلا اگه پرسید آدرس کجاست، اول آدرس رو دقیق بگو، بعد اگه حرف بیشتری داشتی بگو خیلی هم زیاده گویی نکن، مختصر و مفید، مثلا اگه پرسید چجوری ثبت نام کنم اول راجب به ثبت نام و تعیین سطح بگو، حواست باشه که تو ربات مجموعه آموزشی ایران استرالیا هستی و بجز این مدرسه نباید تبلیغ هیچ جای دیگه ای رو بکنی."
+CHITCHAT_PROMPT = """
+شما یک دستیار هوش مصنوعی دوستانه و مفید هستید. لطفاً به این پیام به صورت دوستانه و جامع به فارسی پاسخ دهید:
+پیام کاربر: "{user_input}"
+پاسخ:"""
+# Prepended to a prompt when the chat already has history
+HISTORY_PROMPT = """گفتگوی قبلی شما با این کاربر (فقط برای درک بهتر پیام جدید):
+{history}
+
+"""
+TRANSFER_NOTE = "[گفتگو به اپراتور انسانی منتقل شد]"
+
+# Intents whose handlers answer from the knowledge base
+RETRIEVAL_INTENTS = ("greeting", "visitor_info", "faq")
+
+
+def parse_intent(intent_text: str) -> str:
+    """Cleans up the classifier output to get just the category name."""
+    intent_text = intent_text.strip()
+    if ":" in intent_text:
+        return intent_text.split(":")[-1].strip()
+    return intent_text
+
+
+def history_block(context: str) -> str:
+    return HISTORY_PROMPT.format(history=context) if context else ""
+
+
+# Words that point back at earlier turns ("that one", "the same", "you said", ...)
+FOLLOW_UP_WORDS = {"اون", "آن", "همون", "همان", "این", "اینو", "اونو", "همین", "قبلی", "گفتی", "گفتید", "بالا",
+                   "دیگه", "دیگر", "چطور", "پس", "اونجا", "همونجا", "اینجا"}
+FOLLOW_UP_MAX_WORDS = 2  # Shorter messages ("چقدره؟", "کجا؟") only make sense with the history
+
+
+def follows_up(query: str) -> bool:
+    """True when the message likely depends on earlier turns to be understood."""
+    words = normalize_text(query).split()
+    return len(words) <= FOLLOW_UP_MAX_WORDS or any(word in FOLLOW_UP_WORDS for word in words)
+
+
+def with_history(prompt: str, context: str) -> str:
+    """Prefixes a prompt with the session's compacted history, if any."""
+    return history_block(context) + prompt
+
+
+def human_message(content: str):
+    """Wraps a prompt as a single-message chat input."""
+    from langchain_core.messages import HumanMessage
+    return [HumanMessage(content=content)]
+
+
+def system_and_human(system: str, content: str):
+    from langchain_core.messages import HumanMessage, SystemMessage
+    return [SystemMessage(content=system), HumanMessage(content=content)]
+
+
+def index_fingerprint(path: str):
+    """Identifies one build of the index by the files embedder.py writes."""
+    fingerprint = []
+    for name in ("index.faiss", "index.pkl", "manifest.json"):
+        try:
+            stat = os.stat(os.path.join(path, name))
+            fingerprint.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            fingerprint.append(None)
+    return tuple(fingerprint)
+
+
+class KnowledgeBase:
+    """A loaded FAISS index with its BM25 index and retriever, swapped as a whole on reload."""
+
+    def __init__(self, vectorstore, retriever, fingerprint, lexical=None):
+        self.vectorstore = vectorstore
+        self.retriever = retriever
+        self.fingerprint = fingerprint
+        self.lexical = lexical  # LexicalIndex, or None for dense-only retrieval
+
+
+class ChatbotEngine:
+    """Owns the models, the knowledge base and every chatbot pipeline."""
+
+    def __init__(self, vector_store_path: str = VECTOR_STORE_PATH):
+        self.vector_store_path = vector_store_path
+        self.llm = None
+        self.embeddings = None
+        self.kb = None  # KnowledgeBase, or None if the index is not available
+        self.error = None
+        self.loaded_at = None
+        self._load_lock = threading.Lock()
+        self._warmup_thread = None
+        self._pending_fingerprint = None
+        self.answer_cache = AnswerCache()
+        self.complaints = ComplaintSink()
+        self.sessions = SessionStore()
+        self.usage = TokenUsage()
+        self.intent_engine = IntentEngine(
+            load_classifier(),
+            llm_classify=self.llm_detect_intent,
+            allm_classify=self.allm_detect_intent
+        )
+
+    # =================================================================
+    # 3. LOADING, WARMUP AND HOT RELOAD
+    # =================================================================
+    @property
+    def ready(self) -> bool:
+        return self.llm is not None
+
+    def load(self):
+        """Creates the model clients and loads the knowledge base. Safe to call repeatedly."""
+        with self._load_lock:
+            if self.ready:
+                return
+            # Check if the API key is available
+            if not AVALAI_API_KEY: # This check is now based on the imported variable
+                self.error = "AVALAI_API_KEY not found in config.py."
+                print("❌ Error: AVALAI_API_KEY not found in config.py.")
+                print("Please ensure config.py exists and AVALAI_API_KEY is set.")
+                return
+            print("AvalAI API key found. Initializing models and embeddings...")
+            start = time.monotonic()
+            try:
+                from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+                from embedding_store import CachedEmbeddings
+
+                # Initialize ChatOpenAI for both general use and intent detection
+                llm = ChatOpenAI(
+                    model="gpt-4o",
+                    temperature=0.7,
+                    api_key=AVALAI_API_KEY,
+                    base_url=AVALAI_BASE_URL,
+                    stream_usage=True  # Token counts for streamed answers too
+                )
+
+                # Initialize OpenAIEmbeddings, pointing to the AvalAI base_url.
+                # Query embeddings are looked up in the on-disk cache shared with embedder.py
+                # and kept in a bounded in-memory LRU (see embedding_store.py).
+                self.embeddings = CachedEmbeddings(
+                    OpenAIEmbeddings(
+                        model="text-embedding-3-large",
+                        api_key=AVALAI_API_KEY,
+                        base_url=AVALAI_BASE_URL,
+                        check_embedding_ctx_length=EMBEDDING_CHECK_CTX_LENGTH
+                    ),
+                    model="text-embedding-3-large"
+                )
+                self.kb = self.load_knowledge_base()
+                self.llm = llm
+                self.error = None
+                self.loaded_at = time.time()
+                logging.info(f"Chatbot engine loaded in {time.monotonic() - start:.2f}s.")
+                # May download the encoding; the engine is already ready, so a slow download
+                # only delays exact token counts (estimates are used until then).
+                load_token_encoding()
+            except Exception as e:
+                # If anything goes wrong, the error will be printed.
+                self.error = str(e)
+                print(f"\n❌ خطایی در طول راه اندازی یا پرس و جو رخ داد: {e}")
+                print("لطفاً کلید API AvalAI، آدرس پایه، اتصال به اینترنت و وضعیت حساب AvalAI خود را بررسی کنید.")
+
+    def load_knowledge_base(self):
+        """Loads the pre-computed FAISS vector store with its BM25 index."""
+        from vector_index import RETRIEVER_K, load_vectorstore
+
+        path = self.vector_store_path
+        if not os.path.exists(path):
+            print(f"⚠️ Warning: Vectorstore not found at {path}.")
+            print("Please run embedder.py first to create the FAISS index.")
+            return None
+        fingerprint = index_fingerprint(path)
+        try:
+            # Load the local FAISS index (memory-mapped, with the INDEX_* search settings)
+            vectorstore = load_vectorstore(path, self.embeddings)
+            retriever = vectorstore.as_retriever(search_kwargs={"k": RETRIEVER_K})
+            lexical = self.load_lexical_index(vectorstore) if HYBRID_RETRIEVAL else None
+        except Exception as e:
+            print(f"❌ Error loading vectorstore from {path}: {e}")
+            print("Please ensure embedder.py has been run to create the FAISS index.")
+            return None
+        return KnowledgeBase(vectorstore, retriever, fingerprint, lexical)
+
+    def load_lexical_index(self, vectorstore):
+        """Loads the BM25 index saved by embedder.py, or builds it from the docstore if it is missing or stale."""
+        lexical = LexicalIndex.load(self.vector_store_path)
+        # Same number of chunks is not enough: every id must resolve in this docstore
+        if lexical is None or set(lexical.ids) != set(vectorstore.index_to_docstore_id.values()):
+            print("⚠️ Warning: lexical.json is missing or out of date, building the BM25 index from the docstore.")
+            lexical = LexicalIndex.from_vectorstore(vectorstore)
+        return lexical
+
+    def ensure_loaded(self) -> bool:
+        if not self.ready:
+            self.load()
+        return self.ready
+
+    async def aensure_loaded(self) -> bool:
+        if not self.ready:
+            await asyncio.to_thread(self.load)
+        return self.ready
+
+    def warmup(self):
+        """Starts loading in a background thread so startup is not blocked."""
+        if self._warmup_thread is None and not self.ready:
+            self._warmup_thread = threading.Thread(target=self.load, name="chatbot-warmup", daemon=True)
+            self._warmup_thread.start()
+
+    def reload_index(self) -> bool:
+        """Loads a freshly built faiss_index and swaps it in without a restart."""
+        if not self.ready:
+            return False
+        kb = self.load_knowledge_base()
+        if kb is None:
+            return False
+        self.kb = kb
+        self.answer_cache.invalidate()
+        logging.info(f"Reloaded knowledge base from {self.vector_store_path}.")
+        return True
+
+    def reload_if_changed(self) -> bool:
+        """Reloads once the index files have changed and then stayed unchanged for one poll."""
+        if not self.ready:
+            return False
+        fingerprint = index_fingerprint(self.vector_store_path)
+        current = self.kb.fingerprint if self.kb is not None else None
+        if fingerprint == current:
+            self._pending_fingerprint = None
+            return False
+        if fingerprint != self._pending_fingerprint:
+            # Still being written by embedder.py; check again next time.
+            self._pending_fingerprint = fingerprint
+            return False
+        self._pending_fingerprint = None
+        return self.reload_index()
+
+    def status(self) -> dict:
+        warming = self._warmup_thread is not None and self._warmup_thread.is_alive()
+        return {
+            "ready": self.ready,
+            "loading": warming,
+            "knowledge_base": self.kb is not None,
+            "loaded_at": self.loaded_at,
+            "error": self.error,
+        }
+
+    # =================================================================
+    # 4. LLM CALLS
+    # Every LLM request goes through these so its prompt / completion
+    # token counts are recorded in self.usage (see /stats).
+    # =================================================================
+    def complete(self, kind: str, messages) -> str:
+        with span(f"llm_{kind}"):
+            response = self.llm.invoke(messages)
+        self.usage.record(kind, response.usage_metadata)
+        return response.content
+
+    async def acomplete(self, kind: str, messages) -> str:
+        with span(f"llm_{kind}"):
+            response = await self.llm.ainvoke(messages)
+        self.usage.record(kind, response.usage_metadata)
+        return response.content
+
+    async def astream_llm(self, kind: str, messages, transcript: list = None):
+        """Yields segments of the LLM's streamed answer. The raw streamed text,
+        before segmenting, is appended to `transcript` if one is given."""
+        segmenter = TextSegmenter()
+        usage = None
+        # The span includes the time the consumer spends on each segment
+        with span(f"llm_stream_{kind}"):
+            async for chunk in self.llm.astream(messages):
+                usage = chunk.usage_metadata or usage
+                if transcript is not None:
+                    transcript.append(chunk.content)
+                for segment in segmenter.feed(chunk.content):
+                    yield segment
+        for segment in segmenter.flush():
+            yield segment
+        self.usage.record(kind, usage)
+
+    def kb_messages(self, kb, docs, query: str, instructions: str, context: str = ""):
+        """Builds the answer prompt: static system instructions, then the packed context and question."""
+        idf = kb.lexical.idf if kb.lexical is not None else None
+        text, stats = build_context(query, docs, idf=idf)
+        logging.debug(f"Context for {query!r}: {stats}")
+        return system_and_human(
+            KB_SYSTEM_PROMPT.format(instructions=instructions),
+            KB_USER_PROMPT.format(context=text, history=history_block(context), query=query)
+        )
+
+    # =================================================================
+    # 5. INTENT DETECTION FUNCTION
+    # The local classifier in intent.py answers most messages without a
+    # network call; the LLM classifier is only used when it is unsure.
+    # =================================================================
+    def llm_detect_intent(self, user_input: str) -> str:
+        """Classifies the intent of the user input with the LLM."""
+        prompt = INTENT_PROMPT.format(user_input=user_input)
+        return parse_intent(self.complete("intent", human_message(prompt)))
+
+    async def allm_detect_intent(self, user_input: str) -> str:
+        """Async version of llm_detect_intent."""
+        prompt = INTENT_PROMPT.format(user_input=user_input)
+        return parse_intent(await self.acomplete("intent", human_message(prompt)))
+
+    @timed("detect_intent")
+    def detect_intent(self, user_input: str) -> str:
+        """Classifies the intent of the user input."""
+        return self.intent_engine.detect(user_input)
+
+    @timed("detect_intent")
+    async def adetect_intent(self, user_input: str) -> str:
+        """Async version of detect_intent."""
+        return await self.intent_engine.adetect(user_input)
+
+    # =================================================================
+    # 6. HYBRID RETRIEVAL
+    # BM25 and dense rankings are fused by reciprocal rank. When the BM25
+    # hit is unambiguous (an exact branch name, course code or phone
+    # number) the query is answered from it without an embedding call,
+    # and the returned vector is None.
+    # =================================================================
+    def lexical_search(self, kb, query: str):
+        """Returns (BM25 hits, whether the top hit is confident enough on its own)."""
+        if kb.lexical is None:
+            return [], False
+        with span("lexical_search"):
+            hits = kb.lexical.search(query, HYBRID_FETCH_K)
+            return hits, LEXICAL_SKIP_EMBEDDING and kb.lexical.confident(query, hits)
+
+    def fuse(self, kb, hits, dense_docs):
+        """Fuses BM25 hits with dense results and returns the top k documents."""
+        k = kb.retriever.search_kwargs["k"]
+        lexical_docs = [kb.vectorstore.docstore.search(doc_id) for doc_id, _ in hits]
+        by_text = {doc.page_content: doc for doc in dense_docs + lexical_docs}
+        ranking = reciprocal_rank_fusion([[doc.page_content for doc in dense_docs],
+                                          [doc.page_content for doc in lexical_docs]])
+        return [by_text[text] for text in ranking[:k]]
+
+    def dense_search_kwargs(self, kb):
+        if kb.lexical is None:
+            return kb.retriever.search_kwargs
+        return dict(kb.retriever.search_kwargs, k=max(HYBRID_FETCH_K, kb.retriever.search_kwargs["k"]))
+
+    @timed("retrieve")
+    def retrieve(self, kb, query: str):
+        """Hybrid search for the query. Returns (vector or None, docs)."""
+        hits, confident = self.lexical_search(kb, query)
+        if confident:
+            return None, self.fuse(kb, hits, [])
+        with span("embed_query"):
+            vector = self.embeddings.embed_query(query)
+        with span("vector_search"):
+            dense_docs = kb.vectorstore.similarity_search_by_vector(vector, **self.dense_search_kwargs(kb))
+        return vector, self.fuse(kb, hits, dense_docs)
+
+    @timed("retrieve")
+    async def aretrieve(self, kb, query: str):
+        """Async version of retrieve."""
+        hits, confident = self.lexical_search(kb, query)
+        if confident:
+            return None, self.fuse(kb, hits, [])
+        with span("embed_query"):
+            vector = await self.embeddings.aembed_query(query)
+        with span("vector_search"):
+            dense_docs = await kb.vectorstore.asimilarity_search_by_vector(vector, **self.dense_search_kwargs(kb))
+        return vector, self.fuse(kb, hits, dense_docs)
+
+    # =================================================================
+    # 7. INTENT HANDLERS
+    # These functions define the specific actions for each detected intent.
+    # All responses should be comprehensive and in Persian.
+    # Knowledge base answers go through answer_cache: the exact tier is
+    # checked before anything else, the semantic tier once the query
+    # embedding is known, and only a miss reaches the LLM. A follow-up
+    # message that needs the earlier turns to be understood skips the
+    # cache, and answers written with history are not stored in it.
+    # =================================================================
+    def cache_for(self, query: str, context: str):
+        """Returns (answer cache to read or None, whether to store the new answer)."""
+        if context and follows_up(query):
+            return None, False
+        return self.answer_cache, not context
+
+    @timed("answer_from_knowledge_base")
+    def answer_from_knowledge_base(self, kb, query: str, intent: str, instructions: str, context: str = "") -> str:
+        """Answers the query from the vectorstore, reusing cached answers."""
+        cache, store = self.cache_for(query, context)
+        cached = cache.peek(query, intent) if cache else None
+        if cached is not None:
+            return cached
+        vector, docs = self.retrieve(kb, query)
+        cached = cache.get(query, intent, vector) if cache else None
+        if cached is not None:
+            return cached
+        answer = self.complete(intent, self.kb_messages(kb, docs, query, instructions, context))
+        if store:
+            cache.put(query, intent, answer, vector)
+        return answer
+
+    @timed("handle_greeting")
+    def handle_greeting(self, query: str, context: str = ""):
+        """Handles greeting intent, potentially enhanced with info from QA chain, in Persian."""
+        base_response = "سلام، من ربات مجموعه آموزش زبان ایران استرالیا هستم، چجوری میتونم کمکتون کنم؟"
+        kb = self.kb
+        if kb is None:
+            return base_response + "\n\n(توجه: پایگاه دانش برای ارائه اطلاعات بیشتر در دسترس نیست.)"
+        try:
+            # Add prompt engineering for comprehensive Persian response
+            return "\n" + self.answer_from_knowledge_base(kb, query, "greeting", GREETING_INSTRUCTIONS, context)
+        except Exception as e:
+            logging.error(f"Error in handle_greeting: {e}") # <-- LOG THE ERROR
+            logging.error(f"Error in handle_greeting:\n{traceback.format_exc()}")
+            return "3لطفا دوباره بپرسید، خطایی رخ داد"
+
+    @timed("handle_visitor_info")
+    def handle_visitor_info(self, query: str, context: str = ""):
+        """Handles visitor info intent, potentially enhanced with info from QA chain, in Persian."""
+        base_response = "سلام، به نظر میرسه که اولین باره با مدرسه ایران استرالیا داری صحبت میکنی"
+        kb = self.kb
+        if kb is None:
+            return "1لطفا دوباره بپرسید، خطایی رخ داد"
+        try:
+            # Add prompt engineering for comprehensive Persian response
+            return "\n" + self.answer_from_knowledge_base(kb, query, "visitor_info", VISITOR_INFO_INSTRUCTIONS, context)
+        except Exception as e:
+            return "2لطفا دوباره بپرسید، خطایی رخ داد"
+
+    @timed("handle_faq_or_support")
+    def handle_faq_or_support(self, query: str, context: str = ""):
+        """Handles FAQ or support intent, providing comprehensive Persian answers."""
+        kb = self.kb
+        if kb is None:
+            return "متاسفم، پایگاه دانش من در حال حاضر در دسترس نیست. لطفاً مطمئن شوید که فایل‌های داده موجود هستند."
+
+        try:
+            # Add prompt engineering to ensure comprehensive Persian answer
+            return self.answer_from_knowledge_base(kb, query, "faq", FAQ_INSTRUCTIONS, context)
+        except Exception as e:
+            return f"متاسفم، در حال حاضر نمی‌توانم به سوال شما پاسخ دهم. لطفاً بعداً دوباره امتحان کنید. خطای رخ داده: {e}"
+
+    @timed("handle_unrelated")
+    def handle_unrelated(self):
+        return "متأسفم، من اطلاعاتی در این باره ندارم زیرا مأموریت من ارائه اطلاعات و خدمات مرتبط با مدرسه زبان ایران استرالیا است. اگر سؤالی درباره یادگیری زبان انگلیسی یا خدمات مدرسه ایران استرالیا دارید، خوشحال می‌شوم کمک کنم!"
+
+    @timed("handle_complaint")
+    def handle_complaint(self, query: str, session: Session):
+        """Logs the complaint with the visitor's details to the complaint store, then hands the chat to a human (-1)."""
+        # Queued for the background writer in complaints.py, so the reply is never held up by disk I/O
+        self.complaints.submit(make_record(query, session.chat_id, session.name, session.phone_number))
+        return -1
+
+    # =================================================================
+    # 8. MAIN CHATBOT PIPELINE
+    # This function connects intent detection to the appropriate handler.
+    # Each chat_id has its own session (sessions.py) with the visitor's
+    # details and a compacted history that is passed to the prompts.
+    # =================================================================
+    def session_for(self, chat_id: str) -> Session:
+        # Callers without a chat_id get a throwaway session that is never stored.
+        return self.sessions.get(chat_id) if chat_id else Session(None)
+
+    def remember(self, session: Session, user_input: str, response):
+        """Adds the finished turn to the session history."""
+        if session.chat_id is None:
+            return
+        session.add_turn(user_input, TRANSFER_NOTE if response == -1 else response)
+        self.sessions.save(session)
+
+    async def asession_for(self, chat_id: str) -> Session:
+        """session_for for the async pipelines; a shared backend is queried in a worker thread."""
+        if chat_id and self.sessions.backend is not None:
+            return await asyncio.to_thread(self.session_for, chat_id)
+        return self.session_for(chat_id)
+
+    async def aremember(self, session: Session, user_input: str, response):
+        if session.chat_id is not None and self.sessions.backend is not None:
+            return await asyncio.to_thread(self.remember, session, user_input, response)
+        self.remember(session, user_input, response)
+
+    def collect_user_info(self, session: Session, user_input: str):
+        """Asks for the visitor's name and phone number first. Returns a reply, or None once collected."""
+        if not SESSION_COLLECT_INFO or session.info_collected or session.chat_id is None:
+            return None
+        if not session.turns and not session.summary:
+            return "سلام! لطفا نام خود را وارد کنید:"
+        if session.name is None:
+            session.name = user_input.strip()
+            return "متشکرم، لطفا شماره تلفن خود را وارد کنید:"
+        session.phone_number = user_input.strip()
+        session.info_collected = True
+        return f"سلام {session.name}! شماره تلفن شما ({session.phone_number}) ثبت شد. حالا چگونه می‌توانم به شما کمک کنم؟"
+
+    def chatbot_response(self, user_input: str, chat_id: str = None):
+        """
+        The main function that routes user input to the correct handler using session state.
+        """
+        start = time.perf_counter()
+        trace = {"intent": "unavailable"}
+        try:
+            if not self.ensure_loaded():
+                # Without the models the bot cannot answer, so hand the chat to a human.
+                return -1
+            session = self.session_for(chat_id)
+            response = self.respond(user_input, session, trace)
+            self.remember(session, user_input, response)
+            return response
+        finally:
+            self.record_response("sync", trace, start)
+
+    def record_response(self, pipeline: str, trace: dict, start: float):
+        """Counts the message by intent and records the pipeline time (see /metrics)."""
+        MESSAGES.inc(intent=trace["intent"])
+        RESPONSE_SECONDS.observe(time.perf_counter() - start, pipeline=pipeline, intent=trace["intent"])
+
+    def respond(self, user_input: str, session: Session, trace: dict):
+        # First, check if user information has been collected from the session
+        trace["intent"] = "collect_info"
+        reply = self.collect_user_info(session, user_input)
+        if reply is not None:
+            return reply
+
+        # If user information is collected, proceed with intent detection
+        intent = trace["intent"] = self.detect_intent(user_input)
+        context = session.context()
+
+        if intent == "greeting":
+            return self.handle_greeting(user_input, context)
+        elif intent == "visitor_info":
+            return self.handle_visitor_info(user_input, context)
+        elif intent == "faq":
+            return self.handle_visitor_info(user_input, context)
+        elif intent == "complaint":
+            return self.handle_complaint(user_input, session)
+        elif intent == "unrelated":
+            return self.handle_unrelated()
+        elif intent == "chitchat":
+            # For chitchat, we can try to use the LLM directly for a general response in Persian
+            prompt = with_history(CHITCHAT_PROMPT.format(user_input=user_input), context)
+            return self.complete("chitchat", human_message(prompt)).strip()
+        else: # Handles 'unknown'
+            return -1
+
+    # =================================================================
+    # 9. ASYNC CHATBOT PIPELINE
+    # Same routing as chatbot_response, but FAISS retrieval for the raw
+    # query starts while intent detection is still running. The
+    # retrieved documents are reused by the QA handlers, or dropped if
+    # the intent does not need the knowledge base.
+    # =================================================================
+    @timed("answer_from_knowledge_base")
+    async def aanswer_from_knowledge_base(self, kb, query: str, intent: str, instructions: str, retrieval,
+                                          context: str = "") -> str:
+        """Async version of answer_from_knowledge_base, using an already started retrieval task."""
+        cache, store = self.cache_for(query, context)
+        cached = cache.peek(query, intent) if cache else None
+        if cached is not None:
+            retrieval.cancel()
+            return cached
+        vector, docs = await retrieval
+        cached = cache.get(query, intent, vector) if cache else None
+        if cached is not None:
+            return cached
+        answer = await self.acomplete(intent, self.kb_messages(kb, docs, query, instructions, context))
+        if store:
+            cache.put(query, intent, answer, vector)
+        return answer
+
+    async def aroute(self, kb, user_input: str):
+        """Detects the intent while retrieval runs. Returns (intent, retrieval task or None)."""
+        retrieval = asyncio.create_task(self.aretrieve(kb, user_input)) if kb is not None else None
+        try:
+            intent = await self.adetect_intent(user_input)
+        except BaseException:
+            if retrieval is not None:
+                retrieval.cancel()
+            raise
+
+        if intent not in RETRIEVAL_INTENTS and retrieval is not None:
+            # Chitchat, unrelated and transfers never look at the knowledge base.
+            retrieval.cancel()
+            retrieval = None
+        return intent, retrieval
+
+    async def achatbot_response(self, user_input: str, chat_id: str = None):
+        """
+        Async version of chatbot_response with intent detection and retrieval running concurrently.
+        """
+        start = time.perf_counter()
+        trace = {"intent": "unavailable"}
+        try:
+            if not await self.aensure_loaded():
+                return -1
+            session = await self.asession_for(chat_id)
+            response = await self.arespond(user_input, session, trace)
+            await self.aremember(session, user_input, response)
+            return response
+        finally:
+            self.record_response("async", trace, start)
+
+    async def arespond(self, user_input: str, session: Session, trace: dict):
+        trace["intent"] = "collect_info"
+        reply = self.collect_user_info(session, user_input)
+        if reply is not None:
+            return reply
+        kb = self.kb
+        intent, retrieval = await self.aroute(kb, user_input)
+        trace["intent"] = intent
+        context = session.context()
+
+        if intent == "greeting":
+            if retrieval is None:
+                return self.handle_greeting(user_input, context)
             try:
-                # Add prompt engineering for comprehensive Persian response
-                query_for_qa = f"لطفا جواب بده و تو هم سلام و احوالپرسی کن، حواست باشه که تو ربات مجموعه آموزشی ایران استرالیا هستی و بجز این مدرسه نباید تبلیغ هیچ جای دیگه ای رو بکنی.: {query}"
-                result = qa_chain.invoke({"query": query_for_qa})
-                return "\n" + result['result']
+                return "\n" + await self.aanswer_from_knowledge_base(kb, user_input, "greeting", GREETING_INSTRUCTIONS, retrieval, context)
             except Exception as e:
-                logging.error(f"Error in handle_greeting: {e}") # <-- LOG THE ERROR
-                logging.error(f"Error in handle_greeting:\n{traceback.format_exc()}")
+                logging.error(f"Error in achatbot_response (greeting):\n{traceback.format_exc()}")
                 return "3لطفا دوباره بپرسید، خطایی رخ داد"
-     
-        def handle_visitor_info(query: str):
-            """Handles visitor info intent, potentially enhanced with info from QA chain, in Persian."""
-            base_response = "سلام، به نظر میرسه که اولین باره با مدرسه ایران استرالیا داری صحبت میکنی"
-            if qa_chain is None:
-                return "1لطفا دوباره بپرسید، خطایی رخ داد"
+        elif intent in ("visitor_info", "faq"):
+            if retrieval is None:
+                return self.handle_visitor_info(user_input, context)
             try:
-                # Add prompt engineering for comprehensive Persian response
-                query_for_qa = f" سعی کن در قامت یک ربات فروش محصول کاربر را قانع کنی که یادگیری زبان کار مفیدی است و باید هرچه زودتر شروع کند و کجا بهتر از مدرسه ایران استرالیا، البته قبل از هر چیز اول جواب سوال پرسیده شده رو بده، مثلا اگه پرسید آدرس کجاست، اول آدرس رو دقیق بگو، بعد اگه حرف بیشتری داشتی بگو خیلی هم زیاده گویی نکن، مختصر و مفید، مثلا اگه پرسید چجوری ثبت نام کنم اول راجب به ثبت نام و تعیین سطح بگو، حواست باشه که تو ربات مجموعه آموزشی ایران استرالیا هستی و بجز این مدرسه نباید تبلیغ هیچ جای دیگه ای رو بکنی {query}"
-                result = qa_chain.invoke({"query": query_for_qa})
-                return "\n" + result['result']
+                return "\n" + await self.aanswer_from_knowledge_base(kb, user_input, "visitor_info", VISITOR_INFO_INSTRUCTIONS, retrieval, context)
             except Exception as e:
                 return "2لطفا دوباره بپرسید، خطایی رخ داد"
-            
-        def handle_faq_or_support(query: str):
-            """Handles FAQ or support intent, providing comprehensive Persian answers."""
-            if not qa_chain:
-                return "متاسفم، پایگاه دانش من در حال حاضر در دسترس نیست. لطفاً مطمئن شوید که فایل‌های داده موجود هستند."
-            
-            # Add prompt engineering to ensure comprehensive Persian answer
-            query_for_qa = f"لطفاً به این سوال به طور کامل، و با جزئیات کافی به فارسی پاسخ دهید: {query}"
-            
+        elif intent == "complaint":
+            return self.handle_complaint(user_input, session)
+        elif intent == "unrelated":
+            return self.handle_unrelated()
+        elif intent == "chitchat":
+            prompt = with_history(CHITCHAT_PROMPT.format(user_input=user_input), context)
+            return (await self.acomplete("chitchat", human_message(prompt))).strip()
+        else: # Handles 'unknown'
+            return -1
+
+    # =================================================================
+    # 10. STREAMING CHATBOT PIPELINE
+    # Same routing as achatbot_response, but LLM answers are read from
+    # the token stream and yielded in sentence/paragraph segments as
+    # soon as each one is complete (see streaming.py).
+    # =================================================================
+    async def astream_from_knowledge_base(self, kb, query: str, intent: str, instructions: str, retrieval,
+                                          context: str = ""):
+        """Streaming version of aanswer_from_knowledge_base."""
+        cache, store = self.cache_for(query, context)
+        cached = cache.peek(query, intent) if cache else None
+        if cached is not None:
+            retrieval.cancel()
+            yield cached
+            return
+        vector, docs = await retrieval
+        cached = cache.get(query, intent, vector) if cache else None
+        if cached is not None:
+            yield cached
+            return
+        # Cached as streamed, so a later hit is formatted like the non-streamed answer
+        transcript = []
+        with span("answer_from_knowledge_base"):
+            async for segment in self.astream_llm(intent, self.kb_messages(kb, docs, query, instructions, context),
+                                                  transcript):
+                yield segment
+        if store:
+            cache.put(query, intent, "".join(transcript), vector)
+
+    async def astream_chatbot_response(self, user_input: str, chat_id: str = None):
+        """
+        Streaming version of achatbot_response. Yields answer segments, or a single -1 for a transfer.
+        """
+        start = time.perf_counter()
+        trace = {"intent": "unavailable"}
+        if not await self.aensure_loaded():
+            self.record_response("stream", trace, start)
+            yield -1
+            return
+        session = await self.asession_for(chat_id)
+        segments = []
+        try:
+            async for segment in self.astream_respond(user_input, session, trace):
+                segments.append(segment)
+                yield segment
+        finally:
+            self.record_response("stream", trace, start)
+            if segments:
+                await self.aremember(session, user_input, -1 if segments == [-1] else "\n".join(segments))
+
+    async def astream_respond(self, user_input: str, session: Session, trace: dict):
+        trace["intent"] = "collect_info"
+        reply = self.collect_user_info(session, user_input)
+        if reply is not None:
+            yield reply
+            return
+        kb = self.kb
+        intent, retrieval = await self.aroute(kb, user_input)
+        trace["intent"] = intent
+        context = session.context()
+
+        if intent in RETRIEVAL_INTENTS and retrieval is not None:
+            if intent == "greeting":
+                instructions, cache_intent = GREETING_INSTRUCTIONS, "greeting"
+            else:
+                instructions, cache_intent = VISITOR_INFO_INSTRUCTIONS, "visitor_info"
             try:
-                result = qa_chain.invoke({"query": query_for_qa})
-                return result['result']
+                # The first segment gets the same leading newline as arespond's answers
+                prefix = "\n"
+                async for segment in self.astream_from_knowledge_base(kb, user_input, cache_intent, instructions,
+                                                                      retrieval, context):
+                    yield prefix + segment
+                    prefix = ""
             except Exception as e:
-                return f"متاسفم، در حال حاضر نمی‌توانم به سوال شما پاسخ دهم. لطفاً بعداً دوباره امتحان کنید. خطای رخ داده: {e}"
-
-        def handle_unrelated():
-                    return "متأسفم، من اطلاعاتی در این باره ندارم زیرا مأموریت من ارائه اطلاعات و خدمات مرتبط با مدرسه زبان ایران استرالیا است. اگر سؤالی درباره یادگیری زبان انگلیسی یا خدمات مدرسه ایران استرالیا دارید، خوشحال می‌شوم کمک کنم!"
-
-
-        def handle_complaint(query: str):
-            """Handles complaint intent, logging to complaints.csv with user details, in Persian."""
-            global user_name, user_phone_number
-            
-            # Create or append to complaints.csv
-            file_exists = os.path.isfile("complaints.csv")
-            with open("complaints.csv", "a", newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                if not file_exists:
-                    writer.writerow(["Name", "Phone Number", "complaint"]) # Write header if file is new
-                writer.writerow([user_name if user_name else "N/A", user_phone_number if user_phone_number else "N/A", query])
-            
-            return "از اینکه این موضوع را با ما در میان گذاشتید متاسفم. شکایت شما ثبت شد و یکی از اعضای تیم پشتیبانی ما به زودی با شما تماس خواهد گرفت."
-
-        # =================================================================
-        # 6. MAIN CHATBOT PIPELINE
-        # This function connects intent detection to the appropriate handler.
-        # =================================================================
-        def chatbot_response(user_input: str):
-            """
-            The main function that routes user input to the correct handler using session state.
-            """
-            # First, check if user information has been collected from the session
-            # if not session.get("info_collected"):
-            #     if session.get("name") is None:
-            #         session["name"] = user_input.strip()
-            #         return "متشکرم، لطفا شماره تلفن خود را وارد کنید:"
-            #     elif session.get("phone_number") is None:
-            #         session["phone_number"] = user_input.strip()
-            #         session["info_collected"] = True
-            #         return f"سلام {session['name']}! شماره تلفن شما ({session['phone_number']}) ثبت شد. حالا چگونه می‌توانم به شما کمک کنم؟"
-
-            # If user information is collected, proceed with intent detection
-            intent = detect_intent(user_input)
-            # logging.info(f"Detected intent: {intent} for chat_id with name {session.get('name')}")
+                logging.error(f"Error in astream_chatbot_response ({intent}):\n{traceback.format_exc()}")
+                yield "لطفا دوباره بپرسید، خطایی رخ داد"
+        elif intent == "greeting":
+            yield self.handle_greeting(user_input, context)
+        elif intent in ("visitor_info", "faq"):
+            yield self.handle_visitor_info(user_input, context)
+        elif intent == "complaint":
+            yield self.handle_complaint(user_input, session)
+        elif intent == "unrelated":
+            yield self.handle_unrelated()
+        elif intent == "chitchat":
+            prompt = with_history(CHITCHAT_PROMPT.format(user_input=user_input), context)
+            async for segment in self.astream_llm("chitchat", human_message(prompt)):
+                yield segment
+        else: # Handles 'unknown'
+            yield -1
 
 
-            if intent == "greeting":
-                return handle_greeting(user_input)
-            elif intent == "visitor_info":
-                return handle_visitor_info(user_input)
-            elif intent == "faq":
-                return handle_visitor_info(user_input)
-            elif intent == "unrelated":
-                return handle_unrelated(user_input)
-            elif intent == "chitchat":
-                # For chitchat, we can try to use the LLM directly for a general response in Persian
-                prompt = f"""
-شما یک دستیار هوش مصنوعی دوستانه و مفید هستید. لطفاً به این پیام به صورت دوستانه و جامع به فارسی پاسخ دهید:
-پیام کاربر: "{user_input}"
-پاسخ:"""
-                response = llm.invoke([HumanMessage(content=prompt)])
-                return response.content.strip()
-            else: # Handles 'unknown'
-                return -1
+# =================================================================
+# 11. DEFAULT ENGINE
+# main.py and other callers use these module-level entry points.
+# =================================================================
+engine = ChatbotEngine()
+answer_cache = engine.answer_cache
+intent_engine = engine.intent_engine
+
+
+def chatbot_response(user_input: str, chat_id: str = None):
+    return engine.chatbot_response(user_input, chat_id)
+
+
+async def achatbot_response(user_input: str, chat_id: str = None):
+    return await engine.achatbot_response(user_input, chat_id)
+
 
-    except Exception as e:
-        # If anything goes wrong, the error will be printed.
-        print(f"\n❌ خطایی در طول راه اندازی یا پرس و جو رخ داد: {e}")
-        print("لطفاً کلید API AvalAI، آدرس پایه، اتصال به اینترنت و وضعیت حساب AvalAI خود را بررسی کنید.")
\ No newline at end of file
+def astream_chatbot_response(user_input: str, chat_id: str = None):
+    return engine.astream_chatbot_response(user_input, chat_id)
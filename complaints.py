@@ -0,0 +1,363 @@
+# =================================================================
+# complaints.py
+# Complaint log. Handlers hand complaints to a ComplaintSink, which
+# returns immediately; one background writer thread batches them and
+# flushes each batch to a ComplaintStore: SQLite in WAL mode (safe with
+# several uvicorn workers sharing the file) or size-rotated CSV/JSONL
+# files guarded by a file lock. COMPLAINT_DURABILITY picks how hard each
+# batch is pushed to disk.
+#
+# Usage:
+#   python complaints.py query --since 2025-01-01 --contains کلاس
+#   python complaints.py export --format csv --out complaints_export.csv
+# =================================================================
+import argparse
+import csv
+import glob
+import io
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+COMPLAINT_BACKEND = os.environ.get("COMPLAINT_BACKEND", "sqlite")                 # "sqlite", "csv" or "jsonl"
+COMPLAINT_PATH = os.environ.get("COMPLAINT_PATH", "")                             # Defaults to complaints.<backend extension>
+COMPLAINT_DURABILITY = os.environ.get("COMPLAINT_DURABILITY", "full")             # "full" fsyncs every batch; "normal" / "off" map to SQLite synchronous levels, files leave it to the OS
+COMPLAINT_BATCH_SIZE = int(os.environ.get("COMPLAINT_BATCH_SIZE", 50))            # Complaints written per flush
+COMPLAINT_FLUSH_INTERVAL = float(os.environ.get("COMPLAINT_FLUSH_INTERVAL", 1.0)) # Seconds a partial batch may wait
+COMPLAINT_QUEUE_SIZE = int(os.environ.get("COMPLAINT_QUEUE_SIZE", 10000))
+COMPLAINT_ROTATE_MB = float(os.environ.get("COMPLAINT_ROTATE_MB", 10))            # CSV/JSONL files are rotated past this size, 0 disables
+
+FIELDS = ["created_at", "chat_id", "name", "phone_number", "complaint"]
+# Header of the original complaints.csv, kept for the CSV backend
+CSV_HEADER = ["Created At", "Chat ID", "Name", "Phone Number", "complaint"]
+DEFAULT_PATHS = {"sqlite": "complaints.db", "csv": "complaints.csv", "jsonl": "complaints.jsonl"}
+
+
+def make_record(complaint: str, chat_id: str = None, name: str = None, phone_number: str = None) -> dict:
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "chat_id": chat_id or "",
+        "name": name or "N/A",
+        "phone_number": phone_number or "N/A",
+        "complaint": complaint,
+    }
+
+
+def _matches(record: dict, since: str = None, until: str = None, chat_id: str = None, contains: str = None) -> bool:
+    if since and record["created_at"] < since:
+        return False
+    if until and record["created_at"] >= until:
+        return False
+    if chat_id and record["chat_id"] != chat_id:
+        return False
+    if contains and contains not in record["complaint"]:
+        return False
+    return True
+
+
+# =================================================================
+# 1. STORES
+# =================================================================
+class ComplaintStore(ABC):
+    """Where complaint batches end up. Only the sink's writer thread calls write_batch()."""
+
+    @abstractmethod
+    def write_batch(self, records):
+        ...
+
+    @abstractmethod
+    def query(self, since: str = None, until: str = None, chat_id: str = None, contains: str = None,
+              limit: int = None):
+        """Returns matching complaints, oldest first. Dates are ISO strings, `until` is exclusive."""
+
+    def close(self):
+        pass
+
+
+class SQLiteComplaintStore(ComplaintStore):
+    """Complaints table in a WAL-mode SQLite database."""
+
+    SYNCHRONOUS = {"full": "FULL", "normal": "NORMAL", "off": "OFF"}
+
+    def __init__(self, path: str = DEFAULT_PATHS["sqlite"], durability: str = COMPLAINT_DURABILITY):
+        self.path = path
+        self.durability = durability
+        self._conn = None
+
+    def _connect(self):
+        # Opened lazily so the connection belongs to the thread that uses it.
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS.get(self.durability, 'FULL')}")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS complaints ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at TEXT NOT NULL, chat_id TEXT, "
+                "name TEXT, phone_number TEXT, complaint TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS complaints_created_at ON complaints (created_at)")
+            self._conn = conn
+        return self._conn
+
+    def write_batch(self, records):
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                f"INSERT INTO complaints ({', '.join(FIELDS)}) VALUES (?, ?, ?, ?, ?)",
+                [tuple(r[f] for f in FIELDS) for r in records]
+            )
+
+    def query(self, since=None, until=None, chat_id=None, contains=None, limit=None):
+        clauses, params = [], []
+        for clause, value in (("created_at >= ?", since), ("created_at < ?", until), ("chat_id = ?", chat_id),
+                              ("instr(complaint, ?) > 0", contains)):
+            if value:
+                clauses.append(clause)
+                params.append(value)
+        sql = f"SELECT {', '.join(FIELDS)} FROM complaints"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return [dict(zip(FIELDS, row)) for row in self._connect().execute(sql, params)]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class RotatingFileComplaintStore(ComplaintStore):
+    """Appends CSV or JSONL rows, rotating the file past a size limit.
+
+    Each batch is written under an exclusive lock on a side file, so
+    several processes can share one log without interleaving rows or
+    racing on the CSV header.
+    """
+
+    def __init__(self, path: str, fmt: str = "csv", rotate_mb: float = COMPLAINT_ROTATE_MB,
+                 durability: str = COMPLAINT_DURABILITY):
+        self.path = path
+        self.fmt = fmt
+        self.rotate_bytes = int(rotate_mb * 1024 * 1024)
+        self.durability = durability
+
+    def _encode(self, records, with_header: bool) -> str:
+        if self.fmt == "jsonl":
+            return "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if with_header:
+            writer.writerow(CSV_HEADER)
+        writer.writerows([r[f] for f in FIELDS] for r in records)
+        return buffer.getvalue()
+
+    def write_batch(self, records):
+        with open(self.path + ".lock", "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if self.rotate_bytes and size >= self.rotate_bytes:
+                os.replace(self.path, f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+                size = 0
+            with open(self.path, "a", newline="", encoding="utf-8") as f:
+                f.write(self._encode(records, with_header=size == 0))
+                f.flush()
+                if self.durability == "full":
+                    os.fsync(f.fileno())
+
+    def files(self):
+        """Rotated files oldest first, then the live file."""
+        rotated = sorted(glob.glob(glob.escape(self.path) + ".*[0-9]"))
+        return rotated + ([self.path] if os.path.exists(self.path) else [])
+
+    def _read(self, path):
+        with open(path, newline="", encoding="utf-8") as f:
+            if self.fmt == "jsonl":
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+                return
+            rows = csv.reader(f)
+            for row in rows:
+                if row == CSV_HEADER or row == CSV_HEADER[2:]:
+                    continue
+                if len(row) == 3:
+                    # Rows from the original Name / Phone Number / complaint layout
+                    row = ["", ""] + row
+                yield dict(zip(FIELDS, row))
+
+    def query(self, since=None, until=None, chat_id=None, contains=None, limit=None):
+        results = []
+        for path in self.files():
+            for record in self._read(path):
+                if _matches(record, since, until, chat_id, contains):
+                    results.append(record)
+                    if limit and len(results) >= limit:
+                        return results
+        return results
+
+
+def open_store(backend: str = COMPLAINT_BACKEND, path: str = COMPLAINT_PATH) -> ComplaintStore:
+    """Creates the configured ComplaintStore."""
+    path = path or DEFAULT_PATHS.get(backend, "")
+    if backend == "sqlite":
+        return SQLiteComplaintStore(path)
+    if backend in ("csv", "jsonl"):
+        return RotatingFileComplaintStore(path, fmt=backend)
+    raise ValueError(f"Unknown complaint backend: {backend}")
+
+
+# =================================================================
+# 2. BACKGROUND SINK
+# =================================================================
+class ComplaintSink:
+    """Non-blocking front of a ComplaintStore with a single batching writer thread."""
+
+    def __init__(self, store: ComplaintStore = None, batch_size: int = COMPLAINT_BATCH_SIZE,
+                 flush_interval: float = COMPLAINT_FLUSH_INTERVAL, queue_size: int = COMPLAINT_QUEUE_SIZE):
+        self._store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    @property
+    def store(self) -> ComplaintStore:
+        if self._store is None:
+            self._store = open_store()
+        return self._store
+
+    def submit(self, record: dict) -> bool:
+        """Queues a complaint for the writer. Never blocks."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            # Keep the complaint in the application log rather than lose it silently.
+            logging.error(f"Complaint queue is full, dropping complaint: {json.dumps(record, ensure_ascii=False)}")
+            return False
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="complaint-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch:
+                self._write(batch)
+        self.store.close()
+
+    def _write(self, batch):
+        try:
+            self.store.write_batch(batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            logging.error(f"Failed to write {len(batch)} complaints ({e}): "
+                          f"{json.dumps(batch, ensure_ascii=False)}")
+
+    def close(self, timeout: float = 10.0):
+        """Writes out everything queued and stops the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+# =================================================================
+# 3. EXPORT / QUERY COMMAND
+# =================================================================
+def write_records(records, fmt: str, out):
+    if fmt == "jsonl":
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    writer.writerows([r[f] for f in FIELDS] for r in records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or export logged complaints.")
+    parser.add_argument("command", choices=["query", "export"])
+    parser.add_argument("--backend", choices=["sqlite", "csv", "jsonl"], default=COMPLAINT_BACKEND)
+    parser.add_argument("--path", default=COMPLAINT_PATH)
+    parser.add_argument("--since", help="ISO date or time, inclusive")
+    parser.add_argument("--until", help="ISO date or time, exclusive")
+    parser.add_argument("--chat-id")
+    parser.add_argument("--contains")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    parser.add_argument("--out", help="Output file for export (default: stdout)")
+    args = parser.parse_args()
+
+    store = open_store(args.backend, args.path)
+    records = store.query(args.since, args.until, args.chat_id, args.contains, args.limit)
+    store.close()
+    if args.command == "query":
+        for record in records:
+            print(f"{record['created_at']}  {record['chat_id'] or '-'}  {record['name']}  "
+                  f"{record['phone_number']}  {record['complaint']}")
+        print(f"{len(records)} complaints")
+        return
+    if args.out:
+        with open(args.out, "w", newline="", encoding="utf-8") as f:
+            write_records(records, args.format, f)
+        print(f"Exported {len(records)} complaints to {args.out}")
+    else:
+        write_records(records, args.format, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# =================================================================
+# context_builder.py
+# Builds the knowledge-base context for an answer prompt. Retrieved
+# chunks are split into passages, exact and near-duplicate passages
+# are dropped, the rest are reranked by query-term overlap fused with
+# the retrieval order, and packed greedily into a token budget, so a
+# single large document can no longer flood the prompt. TokenUsage
+# keeps the prompt / completion token counts reported by the LLM.
+# =================================================================
+import logging
+import os
+import re
+from collections import defaultdict
+
+from intent import normalize_text
+from lexical_index import reciprocal_rank_fusion
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1200))               # Tokens of retrieved text per prompt
+CONTEXT_PASSAGE_CHARS = int(os.environ.get("CONTEXT_PASSAGE_CHARS", 600))              # Retrieved chunks are split into passages of about this size
+CONTEXT_DUPLICATE_OVERLAP = float(os.environ.get("CONTEXT_DUPLICATE_OVERLAP", 0.8))    # Word-set overlap at which a passage counts as a duplicate
+TOKEN_ENCODING = os.environ.get("TOKEN_ENCODING", "o200k_base")                        # tiktoken encoding of the answer model
+CHARS_PER_TOKEN = 3  # Estimate for Persian text when tiktoken is unavailable
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?؟])\s+|\n")
+
+_encoding = None  # Set by load_token_encoding(); False if it could not be loaded
+
+
+def load_token_encoding():
+    """Loads the tiktoken encoding. Call from a background thread: the first
+    use downloads it, without a timeout, which can stall or fail offline."""
+    global _encoding
+    if _encoding is not None:
+        return
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as e:
+        logging.warning(f"tiktoken encoding {TOKEN_ENCODING} unavailable ({e}); estimating token counts.")
+        _encoding = False
+
+
+def count_tokens(text: str) -> int:
+    """Counts tokens with the loaded encoding, or estimates them until it is loaded."""
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+# =================================================================
+# 1. PASSAGES
+# =================================================================
+def _pieces(text: str, max_chars: int):
+    """Splits text at paragraph, then sentence, then hard boundaries."""
+    for paragraph in _PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_chars:
+            if paragraph:
+                yield paragraph
+            continue
+        for sentence in _SENTENCE_BREAK.split(paragraph):
+            sentence = sentence.strip()
+            for i in range(0, len(sentence), max_chars):
+                if sentence[i:i + max_chars]:
+                    yield sentence[i:i + max_chars]
+
+
+def split_passages(text: str, max_chars: int = CONTEXT_PASSAGE_CHARS):
+    """Returns passages of up to max_chars, merging short neighbouring pieces."""
+    passages = []
+    current = ""
+    for piece in _pieces(text, max_chars):
+        if current and len(current) + len(piece) + 1 > max_chars:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+
+# =================================================================
+# 2. DEDUPE, RERANK AND PACK
+# =================================================================
+def build_context(query: str, docs, budget: int = CONTEXT_TOKEN_BUDGET, idf: dict = None,
+                  passage_chars: int = CONTEXT_PASSAGE_CHARS, duplicate_overlap: float = CONTEXT_DUPLICATE_OVERLAP):
+    """Packs the most relevant passages of the retrieved docs into `budget` tokens.
+
+    `docs` are in retrieval order. `idf` (from the BM25 index) weights
+    query terms for reranking; without it every term counts the same.
+    Returns (context text, stats dict).
+    """
+    passages = []     # (retrieval rank, text, word set)
+    duplicates = 0
+    for doc in docs:
+        for text in split_passages(doc.page_content, passage_chars):
+            words = set(normalize_text(text).split())
+            if not words:
+                continue
+            if any(len(words & seen) >= duplicate_overlap * min(len(words), len(seen)) for _, _, seen in passages):
+                duplicates += 1
+                continue
+            passages.append((len(passages), text, words))
+
+    terms = set(normalize_text(query).split())
+    overlap = {rank: sum((idf or {}).get(t, 1.0) for t in terms & words) for rank, _, words in passages}
+    by_overlap = sorted(overlap, key=lambda rank: overlap[rank], reverse=True)
+    ranking = reciprocal_rank_fusion([list(range(len(passages))), by_overlap])
+
+    selected = []
+    used = 0
+    for rank in ranking:
+        text = passages[rank][1]
+        tokens = count_tokens(text)
+        if used + tokens > budget:
+            continue
+        selected.append(rank)
+        used += tokens
+    # Keep packed passages in document order so neighbouring text reads naturally
+    context = "\n\n".join(passages[rank][1] for rank in sorted(selected))
+    return context, {"passages": len(passages), "duplicates": duplicates, "packed": len(selected),
+                     "context_tokens": used}
+
+
+# =================================================================
+# 3. TOKEN USAGE
+# =================================================================
+class TokenUsage:
+    """Prompt / completion token totals per kind of LLM call."""
+
+    def __init__(self):
+        self._totals = defaultdict(lambda: {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                            "cached_prompt_tokens": 0})
+
+    def record(self, kind: str, usage) -> dict:
+        """Adds one call's usage_metadata (None if the provider reported none) and logs it."""
+        if not usage:
+            return {}
+        details = usage.get("input_token_details") or {}
+        request = {
+            "prompt_tokens": usage.get("input_tokens", 0),
+            "completion_tokens": usage.get("output_tokens", 0),
+            "cached_prompt_tokens": details.get("cache_read", 0) or 0,
+        }
+        totals = self._totals[kind]
+        totals["requests"] += 1
+        for key, value in request.items():
+            totals[key] += value
+        logging.info(f"LLM usage ({kind}): prompt={request['prompt_tokens']} "
+                     f"(cached {request['cached_prompt_tokens']}), completion={request['completion_tokens']}")
+        return request
+
+    def stats(self) -> dict:
+        return {kind: dict(totals) for kind, totals in self._totals.items()}
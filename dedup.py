@@ -0,0 +1,139 @@
+# =================================================================
+# dedup.py
+# Idempotency for Goftino webhooks. Goftino redelivers a new_message
+# when our response is slow, so every message is claimed once by its
+# identity (message_id, or a hash of chat, timestamp and text when
+# there is none) in a time-windowed, size-bounded seen-set. A message
+# with neither an id nor a timestamp has no identity and is never
+# dropped: a visitor may well send "بله" twice. With
+# DEDUP_BACKEND=sqlite the set is also kept in a shared SQLite file,
+# so a retry that lands on another uvicorn worker is caught too.
+#
+# Claims are made before the message is processed: a message whose
+# run fails is not retried (at-most-once), which is what we want for
+# replies and transfers the visitor would otherwise get twice.
+# =================================================================
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEDUP_BACKEND = os.environ.get("DEDUP_BACKEND", "memory")                  # "memory" or "sqlite"
+DEDUP_PATH = os.environ.get("DEDUP_PATH", "dedup.db")
+DEDUP_WINDOW = float(os.environ.get("DEDUP_WINDOW", 600))                  # Seconds a message identity is remembered
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", 50000))        # In-memory identities before the oldest are dropped
+
+
+def message_key(data: dict):
+    """Identity of a webhook message: its message_id, else a hash of its contents.
+    None when there is neither an id nor a timestamp to tell a retry from a repeat."""
+    message_id = data.get("message_id") or data.get("id")
+    if message_id:
+        return f"id:{message_id}"
+    sent_at = data.get("date") or data.get("timestamp")
+    if not sent_at:
+        return None
+    parts = [data.get("chat_id"), sent_at, data.get("content")]
+    return "sha1:" + hashlib.sha1("\x1f".join(str(p or "") for p in parts).encode("utf-8")).hexdigest()
+
+
+class SQLiteSeenBackend:
+    """Seen-set shared between processes through a WAL-mode SQLite file."""
+
+    PURGE_EVERY = 1000  # Claims between deletes of expired rows
+
+    def __init__(self, path: str = DEDUP_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._claims = 0
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, at REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def claim(self, key: str, now: float, window: float) -> bool:
+        """Marks the key as seen. False if another process saw it within the window."""
+        conn = self._connect()
+        with conn:
+            # Inserts a new key or takes over an expired one in a single atomic statement
+            claimed = conn.execute(
+                "INSERT INTO seen (key, at) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET at = excluded.at "
+                "WHERE seen.at < ?", (key, now, now - window)
+            ).rowcount == 1
+            self._claims += 1
+            if self._claims % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM seen WHERE at < ?", (now - window,))
+        return claimed
+
+
+class MessageDeduplicator:
+    """Time-windowed, size-bounded set of message identities already accepted."""
+
+    def __init__(self, backend=None, window: float = DEDUP_WINDOW, max_entries: int = DEDUP_MAX_ENTRIES):
+        if backend is None and DEDUP_BACKEND == "sqlite":
+            backend = SQLiteSeenBackend()
+        self.backend = backend
+        self.window = window
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # key -> time first seen, oldest first
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.duplicates = 0
+
+    def seen(self, key: str) -> bool:
+        """Claims the key. True if it was already seen within the window (a duplicate).
+        A None key (a message without identity) is never a duplicate."""
+        if key is None:
+            return self._count(False)
+        now = time.time()
+        duplicate = self._seen_locally(key, now)
+        if not duplicate and self.backend is not None:
+            duplicate = not self.backend.claim(key, now, self.window)
+        return self._count(duplicate)
+
+    async def aseen(self, key: str) -> bool:
+        """seen() for the event loop: the shared backend, which may wait on another
+        process's write lock, is claimed in a worker thread."""
+        if key is None:
+            return self._count(False)
+        now = time.time()
+        duplicate = self._seen_locally(key, now)
+        if not duplicate and self.backend is not None:
+            duplicate = not await asyncio.to_thread(self.backend.claim, key, now, self.window)
+        return self._count(duplicate)
+
+    def _seen_locally(self, key: str, now: float) -> bool:
+        with self._lock:
+            while self._seen:
+                at = next(iter(self._seen.values()))
+                if now - at <= self.window and len(self._seen) < self.max_entries:
+                    break
+                self._seen.popitem(last=False)
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            return False
+
+    def _count(self, duplicate: bool) -> bool:
+        if duplicate:
+            self.duplicates += 1
+        else:
+            self.accepted += 1
+        return duplicate
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._seen),
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+        }
@@ -0,0 +1,181 @@
+# =================================================================
+# dispatcher.py
+# Runs the chatbot pipeline off the event loop. Webhooks enqueue
+# messages into a bounded queue; a fixed pool of async workers pulls
+# them off, limits concurrency per chat and hands the blocking
+# pipeline to a thread pool executor. A worker never waits on a busy
+# chat: the chat is deferred and run by the worker that finishes its
+# current run, so one visitor's burst cannot tie up the whole pool.
+#
+# Messages from one chat that arrive while its next run is still queued
+# (or deferred behind the run in flight) are merged into that run, so a
+# visitor typing a question in several short messages gets one answer
+# instead of one per fragment. Isolated messages never wait for this.
+# A `coalesce_window` above 0 additionally holds a run until the chat
+# has been quiet that long (at most `coalesce_max_wait`). A run holds
+# at most `coalesce_max_messages` messages and `coalesce_max_chars`
+# characters; past that the chat's next message starts a new run, which
+# takes its own queue slot like any other.
+# =================================================================
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ChatDispatcher:
+    """Bounded queue + worker pool in front of the chatbot pipeline.
+
+    `handler` is a coroutine function `handler(chat_id, user_message)` that
+    does the actual work (typing status, pipeline, reply). Blocking calls
+    inside it should go through `run_blocking` so they run on the executor.
+    Coalesced messages reach it joined by newlines.
+    """
+
+    def __init__(self, handler, workers: int = 4, queue_size: int = 100,
+                 per_chat_limit: int = 1, executor_threads: int = None,
+                 coalesce_window: float = 0.0, coalesce_max_wait: float = None,
+                 coalesce_max_messages: int = 10, coalesce_max_chars: int = 4000):
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_chat_limit = per_chat_limit
+        self.executor_threads = executor_threads or workers
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_wait = coalesce_max_wait if coalesce_max_wait is not None else 3 * coalesce_window
+        self.coalesce_max_messages = coalesce_max_messages
+        self.coalesce_max_chars = coalesce_max_chars
+        self.queue = None
+        self.executor = None
+        self._tasks = []
+        self._running = {}     # chat_id -> runs in progress
+        self._deferred = {}    # chat_id -> runs dequeued while at per_chat_limit, waiting for a run to finish
+        self._pending = {}     # chat_id -> deque of queued runs, oldest first
+        self._open = {}        # chat_id -> the chat's newest run, while it still accepts messages
+        self.shed_count = 0
+        self.coalesced_count = 0
+
+    async def start(self):
+        """Creates the queue, the executor and the worker tasks."""
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.executor_threads, thread_name_prefix="chatbot"
+        )
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"chat-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logging.info(
+            f"Dispatcher started: {self.workers} workers, queue size {self.queue_size}, "
+            f"per-chat limit {self.per_chat_limit}, {self.executor_threads} executor threads, "
+            f"coalesce window {self.coalesce_window}s."
+        )
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Waits briefly for queued messages, then stops the workers."""
+        if self.queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Dispatcher stopped with {self.queue.qsize()} messages still queued.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, chat_id: str, user_message: str) -> bool:
+        """Enqueues a message without waiting. Returns False if the queue is full.
+
+        If the chat already has a run waiting in the queue with room left,
+        the message is added to that run instead and takes no queue slot.
+        """
+        now = time.monotonic()
+        run = self._open.get(chat_id)
+        if (run is not None and len(run[0]) < self.coalesce_max_messages
+                and run[3] + len(user_message) <= self.coalesce_max_chars):
+            run[0].append(user_message)
+            run[2] = now
+            run[3] += len(user_message)
+            self.coalesced_count += 1
+            return True
+        try:
+            self.queue.put_nowait(chat_id)
+        except asyncio.QueueFull:
+            self.shed_count += 1
+            return False
+        # messages, first arrival, last arrival, characters
+        run = [[user_message], now, now, len(user_message)]
+        self._pending.setdefault(chat_id, deque()).append(run)
+        self._open[chat_id] = run
+        return True
+
+    async def run_blocking(self, func, *args):
+        """Runs a synchronous function on the pipeline executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "queue_size": self.queue_size,
+            "workers": self.workers,
+            "active_chats": len(self._running),
+            "deferred": sum(self._deferred.values()),
+            "shed": self.shed_count,
+            "coalesced": self.coalesced_count,
+        }
+
+    # -----------------------------------------------------------------
+    # Internals
+    # -----------------------------------------------------------------
+    async def _take_pending(self, chat_id):
+        """Waits for the chat's burst of messages to end, then takes them as one message."""
+        runs = self._pending[chat_id]
+        run = runs.popleft()
+        if not runs:
+            del self._pending[chat_id]
+        while True:
+            wait = min(run[2] + self.coalesce_window, run[1] + self.coalesce_max_wait) - time.monotonic()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        # Messages arriving from now on start the chat's next run.
+        if self._open.get(chat_id) is run:
+            del self._open[chat_id]
+        return "\n".join(run[0])
+
+    async def _run_chat(self, worker_id: int, chat_id):
+        """Runs the chat, then any run of the same chat that was deferred meanwhile."""
+        while True:
+            self._running[chat_id] = self._running.get(chat_id, 0) + 1
+            try:
+                user_message = await self._take_pending(chat_id)
+                await self.handler(chat_id, user_message)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f"Worker {worker_id} failed while processing chat {chat_id}.")
+            finally:
+                self._running[chat_id] -= 1
+                if self._running[chat_id] == 0:
+                    del self._running[chat_id]
+            if not self._deferred.get(chat_id):
+                return
+            self._deferred[chat_id] -= 1
+            if self._deferred[chat_id] == 0:
+                del self._deferred[chat_id]
+
+    async def _worker(self, worker_id: int):
+        while True:
+            chat_id = await self.queue.get()
+            try:
+                if self._running.get(chat_id, 0) >= self.per_chat_limit:
+                    # The worker running this chat picks it up when it is done.
+                    self._deferred[chat_id] = self._deferred.get(chat_id, 0) + 1
+                    continue
+                await self._run_chat(worker_id, chat_id)
+            finally:
+                self.queue.task_done()
@@ -1,43 +1,304 @@
+# =================================================================
+# embedder.py
+# Builds the FAISS index used by chatbot.py. Source files are streamed
+# and split into overlapping chunks, chunks are embedded in parallel
+# batches with rate-limit aware retries, and a manifest of per-chunk
+# content hashes lets a rebuild reuse the vectors of unchanged chunks
+# instead of re-embedding the whole corpus. Embeddings also go through
+# the on-disk store in embedding_store.py, shared with chatbot.py.
+# A BM25 index of the same chunks (lexical_index.py) is saved with it.
+#
+# Usage:
+#   python embedder.py                 # incremental build
+#   python embedder.py --full          # re-embed everything, bypassing both caches
+#   python embedder.py --mode hnsw --reduce-dim 256
+# =================================================================
+
 # =================================================================
 # 1. IMPORTS
-# All necessary libraries for the Streamlit app.
 # =================================================================
-# import streamlit as st
-from langchain_community.document_loaders import TextLoader
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
-from langchain_openai import ChatOpenAI
-from langchain.chains import RetrievalQA
-from langchain.schema import HumanMessage
-import os
+
 # Import the API key from your config.py file
 from config import AVALAI_API_KEY
+from embedding_store import CachedEmbeddings
+from lexical_index import LexicalIndex
+from vector_index import INDEX_MODE, INDEX_REDUCE_DIM, build_vectorstore, factory_string
 
 AVALAI_BASE_URL = "https://api.avalai.ir/v1"
+EMBEDDING_MODEL = "text-embedding-3-large"
+
+# =================================================================
+# 2. CONFIGURATION
+# =================================================================
+SOURCES = [
+    "data/faqs.csv",
+    "data/services.json",
+    "data/info.md",
+    "data/website_text.txt",
+]
+VECTOR_STORE_PATH = "faiss_index"  # chatbot.py loads the index from here
+MANIFEST_FILE = "manifest.json"
+
+CHUNK_SIZE = int(os.environ.get("EMBED_CHUNK_SIZE", 1500))        # Characters per chunk
+CHUNK_OVERLAP = int(os.environ.get("EMBED_CHUNK_OVERLAP", 200))   # Characters shared by neighbouring chunks
+BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 64))          # Chunks per embedding request
+WORKERS = int(os.environ.get("EMBED_WORKERS", 4))                 # Concurrent embedding requests
+MAX_RETRIES = int(os.environ.get("EMBED_MAX_RETRIES", 6))
+
+READ_BLOCK_SIZE = 64 * 1024
+# Preferred chunk boundaries, best first
+SEPARATORS = ("\n\n", "\n", ". ", "؟ ", "? ", "! ", " ")
+
+
+# =================================================================
+# 3. STREAMING CHUNKER
+# =================================================================
+def _find_cut(text: str, chunk_size: int) -> int:
+    """Picks the end of the next chunk, preferring a natural boundary."""
+    window = text[:chunk_size]
+    for separator in SEPARATORS:
+        cut = window.rfind(separator)
+        if cut >= chunk_size // 2:
+            return cut + len(separator)
+    return chunk_size
+
+
+def iter_chunks(path: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP):
+    """Streams a text file and yields (start_offset, chunk_text) with overlap.
+
+    The file is read in blocks, so large dumps never have to be held in
+    memory as a single string.
+    """
+    buffer = ""
+    offset = 0  # Character offset of buffer[0] in the file
+    with open(path, encoding="utf-8") as f:
+        while True:
+            block = f.read(READ_BLOCK_SIZE)
+            buffer += block
+            while len(buffer) >= chunk_size or (not block and buffer):
+                if not block and len(buffer) <= chunk_size:
+                    cut = len(buffer)
+                else:
+                    cut = _find_cut(buffer, chunk_size)
+                chunk = buffer[:cut].strip()
+                if chunk:
+                    yield offset, chunk
+                if cut >= len(buffer):
+                    buffer = ""
+                    break
+                step = max(cut - overlap, 1)
+                buffer = buffer[step:]
+                offset += step
+            if not block:
+                return
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def collect_chunks(sources, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP):
+    """Chunks every source file. Identical chunks are only kept once."""
+    chunks = []
+    seen = set()
+    for path in sources:
+        if not os.path.exists(path):
+            print(f"⚠️ Warning: source {path} not found, skipping.")
+            continue
+        count = 0
+        for start, text in iter_chunks(path, chunk_size, overlap):
+            digest = content_hash(text)
+            if digest in seen:
+                continue
+            seen.add(digest)
+            chunks.append({"hash": digest, "text": text, "source": path, "start": start})
+            count += 1
+        print(f"{path}: {count} chunks")
+    return chunks
+
+
+# =================================================================
+# 4. PARALLEL EMBEDDING WITH RETRIES
+# =================================================================
+def _retry_delay(error, attempt: int):
+    """Returns how long to wait before retrying, or None if the error is not retryable."""
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    name = type(error).__name__
+    retryable = (
+        status in (408, 409, 429) or (status is not None and status >= 500)
+        or name in ("RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError")
+    )
+    if not retryable:
+        return None
+    retry_after = None
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    backoff = min(60.0, 2 ** attempt) * (0.5 + random.random())
+    return max(backoff, retry_after or 0.0)
+
+
+def embed_batch(embeddings, texts):
+    """Embeds one batch, backing off on rate limits and transient errors.
+
+    `embeddings` is the CachedEmbeddings client, so only texts missing from
+    the embedding store are sent to the API.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                raise
+            print(f"Embedding batch failed ({type(e).__name__}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+def embed_texts(embeddings, texts, batch_size: int = BATCH_SIZE, workers: int = WORKERS):
+    """Embeds texts in parallel batches, preserving order."""
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    vectors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, batch_vectors in enumerate(executor.map(lambda b: embed_batch(embeddings, b), batches), 1):
+            vectors.extend(batch_vectors)
+            print(f"Embedded batch {i}/{len(batches)}")
+    return vectors
+
+
+# =================================================================
+# 5. INCREMENTAL INDEX BUILD
+# =================================================================
+def load_previous_vectors(path: str, embeddings, model: str):
+    """Returns {chunk hash: vector} from the existing index, if it was built the same way."""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("model") != model or manifest.get("index", "Flat") != "Flat":
+        # Only flat indexes store the original vectors; other builds rely on the embedding store.
+        return {}
+    try:
+        previous = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    except Exception as e:
+        print(f"⚠️ Warning: could not load the previous index ({e}), re-embedding everything.")
+        return {}
+    known = set(manifest.get("hashes", []))
+    return {
+        docstore_id: previous.index.reconstruct(position).tolist()
+        for position, docstore_id in previous.index_to_docstore_id.items()
+        if docstore_id in known
+    }
+
+
+def replace_index_files(staging: str, path: str):
+    """Moves the files of a freshly written index over the live ones. os.replace gives
+    each file a new inode, so readers that mapped the old file keep their pages."""
+    names = sorted(os.listdir(staging))
+    # The manifest goes last: it is what marks the new vectors as reusable.
+    names.sort(key=lambda name: name == MANIFEST_FILE)
+    for name in names:
+        os.replace(os.path.join(staging, name), os.path.join(path, name))
+
+
+def build_index(sources=SOURCES, path: str = VECTOR_STORE_PATH, full: bool = False,
+                chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP,
+                batch_size: int = BATCH_SIZE, workers: int = WORKERS,
+                mode: str = INDEX_MODE, reduce_dim: int = INDEX_REDUCE_DIM):
+    """Chunks the sources, embeds new chunks and saves the FAISS index with its manifest."""
+    embeddings = CachedEmbeddings(
+        OpenAIEmbeddings(
+            model=EMBEDDING_MODEL,
+            api_key=AVALAI_API_KEY,
+            base_url=AVALAI_BASE_URL,
+            max_retries=0  # embed_batch does the retrying
+        ),
+        model=EMBEDDING_MODEL
+    )
+
+    chunks = collect_chunks(sources, chunk_size, overlap)
+    if not chunks:
+        print("❌ Error: no documents to index.")
+        return None
 
-# Initialize qa_chain as None. It will be created later if data is available.
-qa_chain = None
+    reused = {} if full else load_previous_vectors(path, embeddings, EMBEDDING_MODEL)
+    missing = [c for c in chunks if c["hash"] not in reused]
+    print(f"{len(chunks)} chunks: {len(chunks) - len(missing)} unchanged, {len(missing)} to embed.")
 
-embeddings = OpenAIEmbeddings(
-    model="text-embedding-3-large",
-    api_key=AVALAI_API_KEY,
-    base_url=AVALAI_BASE_URL
-)
+    client = embeddings.embeddings if full else embeddings
+    new_vectors = embed_texts(client, [c["text"] for c in missing], batch_size, workers) if missing else []
+    vectors = dict(reused)
+    vectors.update(zip((c["hash"] for c in missing), new_vectors))
 
-faq_loader = TextLoader("data/faqs.csv")
-service_loader = TextLoader("data/services.json")
-info_loader = TextLoader('data/info.md')
-# complaints = TextLoader('data/complaints.yaml')
+    matrix = [vectors[c["hash"]] for c in chunks]
+    description = factory_string(mode, len(matrix), len(matrix[0]), reduce_dim)
+    print(f"Building {description} index...")
+    vectorstore = build_vectorstore(
+        [c["text"] for c in chunks],
+        matrix,
+        [{"source": c["source"], "start": c["start"]} for c in chunks],
+        [c["hash"] for c in chunks],
+        embeddings,
+        description
+    )
+    # Everything is written to a fresh directory first and then moved into place
+    # file by file: a running chatbot memory-maps index.faiss, and rewriting that
+    # file in place would truncate pages it is still reading (SIGBUS).
+    os.makedirs(path, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=path)
+    try:
+        vectorstore.save_local(staging)
+        # BM25 index over the same chunks, keyed by the same docstore ids
+        LexicalIndex.build([c["hash"] for c in chunks], [c["text"] for c in chunks]).save(staging)
+        with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump({
+                "model": EMBEDDING_MODEL,
+                "index": description,
+                "chunk_size": chunk_size,
+                "chunk_overlap": overlap,
+                "sources": list(sources),
+                "hashes": [c["hash"] for c in chunks],
+            }, f, indent=2)
+        replace_index_files(staging, path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    print(f"Vectorstore saved successfully to {path}")
+    return vectorstore
 
 
-##
-docs = faq_loader.load() + service_loader.load() + info_loader.load()
+def main():
+    parser = argparse.ArgumentParser(description="Build the FAISS index for the chatbot.")
+    parser.add_argument("--full", action="store_true", help="Re-embed every chunk instead of reusing unchanged ones")
+    parser.add_argument("--sources", nargs="+", default=SOURCES)
+    parser.add_argument("--path", default=VECTOR_STORE_PATH)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--mode", choices=["flat", "hnsw", "ivfpq"], default=INDEX_MODE)
+    parser.add_argument("--reduce-dim", type=int, default=INDEX_REDUCE_DIM, help="PCA target dimension, 0 to disable")
+    args = parser.parse_args()
+    build_index(args.sources, args.path, args.full, args.chunk_size, args.overlap, args.batch_size, args.workers,
+                args.mode, args.reduce_dim)
 
-vectorstore = FAISS.from_documents(docs, embeddings)
-# retriever = vectorstore.as_retriever()
-print("Documents loaded and vectorstore created successfully.")
 
-# --- NEW: Save the vectorstore ---
-vector_store_path = "faiss_index" # Define a path to save your FAISS index
-vectorstore.save_local(vector_store_path)
-print(f"Vectorstore saved successfully to {vector_store_path}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# =================================================================
+# embedding_store.py
+# Persistent embedding cache shared by embedder.py and chatbot.py.
+# Vectors are appended to a flat float32 (or float16) file that is
+# memory-mapped for reads; a parallel keys file maps sha256(model,
+# text) to a row. Document text that has been embedded once never goes
+# over the network again. User queries are looked up in the store but
+# kept only in a bounded in-memory LRU, so the file does not grow with
+# every unique question.
+# =================================================================
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache")
+EMBEDDING_CACHE_DTYPE = os.environ.get("EMBEDDING_CACHE_DTYPE", "float32")  # "float32" or "float16"
+EMBEDDING_QUERY_CACHE_SIZE = int(os.environ.get("EMBEDDING_QUERY_CACHE_SIZE", 1024))  # Query vectors kept in memory
+
+
+def embedding_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """Append-only, memory-mapped vector store keyed by (model, text hash).
+
+    Layout under `path` for each model and dtype:
+      <name>.json     dimension and dtype
+      <name>.keys     one hex key per line; line i is row i
+      <name>.vectors  rows of `dim` values, written before their key
+
+    Writers hold an exclusive flock, so several processes can share the
+    store; readers pick up rows appended by others on their next miss.
+    """
+
+    def __init__(self, model: str, path: str = EMBEDDING_CACHE_PATH, dtype: str = EMBEDDING_CACHE_DTYPE):
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported embedding cache dtype: {dtype}")
+        self.model = model
+        self.dtype = np.dtype(dtype)
+        name = f"{model.replace('/', '_')}.{dtype}"
+        os.makedirs(path, exist_ok=True)
+        self._meta_path = os.path.join(path, name + ".json")
+        self._keys_path = os.path.join(path, name + ".keys")
+        self._vectors_path = os.path.join(path, name + ".vectors")
+        self._lock_path = os.path.join(path, name + ".lock")
+        self._lock = threading.RLock()
+        self.dim = None
+        self._rows = {}
+        self._keys_offset = 0
+        self._mmap = None
+        self.hits = 0
+        self.misses = 0
+        with self._lock:
+            self._refresh()
+
+    # -----------------------------------------------------------------
+    # Public API
+    # -----------------------------------------------------------------
+    def get_many(self, keys):
+        """Returns a list with a float32 vector or None for each key."""
+        with self._lock:
+            if any(key not in self._rows for key in keys):
+                self._refresh()
+            results = []
+            for key in keys:
+                row = self._rows.get(key)
+                if row is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    results.append(np.asarray(self._matrix()[row], dtype=np.float32))
+            return results
+
+    def put_many(self, keys, vectors):
+        """Appends vectors for keys that are not stored yet."""
+        if not keys:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock, _FileLock(self._lock_path):
+            self._refresh()
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self._meta_path, "w") as f:
+                    json.dump({"model": self.model, "dim": self.dim, "dtype": self.dtype.name}, f)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dim vectors, got {vectors.shape[1]}")
+
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self._rows and key not in new:
+                    new[key] = vector
+            if not new:
+                return
+            row_bytes = self.dim * self.dtype.itemsize
+            with open(self._vectors_path, "ab") as f:
+                # Drop any partial rows left by a writer that died before writing its keys.
+                f.truncate(len(self._rows) * row_bytes)
+                f.seek(len(self._rows) * row_bytes)
+                f.write(np.stack(list(new.values())).astype(self.dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._keys_path, "a", encoding="ascii") as f:
+                # Likewise a partial last key line, which the first new key would extend.
+                f.truncate(self._keys_offset)
+                f.write("".join(key + "\n" for key in new))
+            self._refresh()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def stats(self) -> dict:
+        return {"model": self.model, "dtype": self.dtype.name, "entries": len(self._rows),
+                "hits": self.hits, "misses": self.misses}
+
+    # -----------------------------------------------------------------
+    # Internals (called with the lock held)
+    # -----------------------------------------------------------------
+    def _refresh(self):
+        """Reads keys appended since the last refresh."""
+        if self.dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        if not os.path.exists(self._keys_path):
+            return
+        with open(self._keys_path, encoding="ascii") as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        # Ignore a trailing partial line from a concurrent writer.
+        complete = data[:data.rfind("\n") + 1]
+        for key in complete.splitlines():
+            self._rows.setdefault(key, len(self._rows))
+        self._keys_offset += len(complete)
+
+    def _matrix(self):
+        if self._mmap is None or self._mmap.shape[0] < len(self._rows):
+            self._mmap = np.memmap(self._vectors_path, dtype=self.dtype, mode="r",
+                                   shape=(len(self._rows), self.dim))
+        return self._mmap
+
+
+class _FileLock:
+    """Exclusive advisory lock on a file, for writers in other processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._file = open(self.path, "a")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class CachedEmbeddings(Embeddings):
+    """Read-through EmbeddingStore cache around another Embeddings client.
+
+    Document embeddings are written to the store; query embeddings only
+    go into an in-memory LRU of `query_cache_size` vectors. The async
+    methods do store I/O (which may wait on another process's flock) in
+    a worker thread.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, store: EmbeddingStore = None,
+                 query_cache_size: int = EMBEDDING_QUERY_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.model = model
+        self.store = store if store is not None else EmbeddingStore(model)
+        self.query_cache_size = query_cache_size
+        self._queries = OrderedDict()  # text -> float32 vector, least recently used first
+        self._queries_lock = threading.Lock()
+
+    def _lookup(self, texts):
+        """Returns (keys, cached vectors or None, {missing key: text})."""
+        keys = [embedding_key(self.model, text) for text in texts]
+        try:
+            cached = self.store.get_many(keys)
+        except Exception as e:
+            logging.warning(f"Embedding cache read failed: {e}")
+            cached = [None] * len(texts)
+        missing = {key: text for key, text, vector in zip(keys, texts, cached) if vector is None}
+        return keys, cached, missing
+
+    def _merge(self, keys, cached, missing, vectors, persist: bool = True):
+        fetched = dict(zip(missing, vectors))
+        if persist:
+            try:
+                self.store.put_many(list(fetched), vectors)
+            except Exception as e:
+                logging.warning(f"Embedding cache write failed: {e}")
+        results = [fetched[key] if vector is None else vector for key, vector in zip(keys, cached)]
+        return [vector.tolist() if isinstance(vector, np.ndarray) else list(vector) for vector in results]
+
+    def embed_documents(self, texts):
+        keys, cached, missing = self._lookup(texts)
+        vectors = self.embeddings.embed_documents(list(missing.values())) if missing else []
+        return self._merge(keys, cached, missing, vectors)
+
+    def _cached_query(self, text):
+        with self._queries_lock:
+            vector = self._queries.get(text)
+            if vector is None:
+                return None
+            self._queries.move_to_end(text)
+            return vector.tolist()
+
+    def _remember_query(self, text, vector):
+        if self.query_cache_size <= 0:
+            return
+        with self._queries_lock:
+            self._queries[text] = np.asarray(vector, dtype=np.float32)
+            self._queries.move_to_end(text)
+            while len(self._queries) > self.query_cache_size:
+                self._queries.popitem(last=False)
+
+    def embed_query(self, text):
+        vector = self._cached_query(text)
+        if vector is not None:
+            return vector
+        keys, cached, missing = self._lookup([text])
+        vectors = [self.embeddings.embed_query(text)] if missing else []
+        vector = self._merge(keys, cached, missing, vectors, persist=False)[0]
+        self._remember_query(text, vector)
+        return vector
+
+    async def aembed_documents(self, texts):
+        keys, cached, missing = await asyncio.to_thread(self._lookup, texts)
+        vectors = await self.embeddings.aembed_documents(list(missing.values())) if missing else []
+        return await asyncio.to_thread(self._merge, keys, cached, missing, vectors)
+
+    async def aembed_query(self, text):
+        vector = self._cached_query(text)
+        if vector is not None:
+            return vector
+        keys, cached, missing = await asyncio.to_thread(self._lookup, [text])
+        vectors = [await self.embeddings.aembed_query(text)] if missing else []
+        vector = self._merge(keys, cached, missing, vectors, persist=False)[0]
+        self._remember_query(text, vector)
+        return vector
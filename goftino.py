@@ -0,0 +1,185 @@
+# =================================================================
+# goftino.py
+# One pooled HTTP client for all Goftino API calls. It is created in
+# the FastAPI lifespan and reused for every request (HTTP/2 and
+# keep-alive when available), retries 5xx/429 and transport errors
+# with jittered backoff, coalesces redundant typing-status toggles and
+# keeps latency / error counters per endpoint. send_message and
+# transfer_chat are not idempotent, so they are only retried when
+# Goftino cannot have acted on the request (429/503, unsent errors).
+# =================================================================
+import asyncio
+import logging
+import os
+import random
+import time
+
+import httpx
+
+GOFTINO_API_BASE = os.environ.get("GOFTINO_API_BASE", "https://api.goftino.com/v1")
+GOFTINO_SEND_API_URL = f"{GOFTINO_API_BASE}/send_message"
+GOFTINO_TYPING_API_URL = f"{GOFTINO_API_BASE}/operator_typing"
+GOFTINO_TRANSFER_API_URL = f"{GOFTINO_API_BASE}/transfer_chat"
+
+GOFTINO_TIMEOUT = float(os.environ.get("GOFTINO_TIMEOUT", 10))                  # Seconds per request
+GOFTINO_MAX_CONNECTIONS = int(os.environ.get("GOFTINO_MAX_CONNECTIONS", 20))
+GOFTINO_MAX_KEEPALIVE = int(os.environ.get("GOFTINO_MAX_KEEPALIVE", 10))
+GOFTINO_MAX_RETRIES = int(os.environ.get("GOFTINO_MAX_RETRIES", 3))
+GOFTINO_TYPING_DEBOUNCE = float(os.environ.get("GOFTINO_TYPING_DEBOUNCE", 0.5))  # Seconds an "off" waits for a new "on"
+GOFTINO_TYPING_REFRESH = float(os.environ.get("GOFTINO_TYPING_REFRESH", 5))      # Re-send an unchanged "on" after this long
+
+# Transport errors raised before the request was sent. After any other one (a read
+# timeout, a dropped connection) Goftino may already have acted on the POST.
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Statuses that mean the request was refused, not processed. Any other 5xx may
+# arrive after Goftino already posted the reply or made the transfer.
+UNPROCESSED_STATUSES = (429, 503)
+
+
+class EndpointStats:
+    """Request, error and latency counters for one Goftino endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.skipped = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "skipped": self.skipped,
+            "avg_ms": round(self.total_seconds * 1000 / self.requests, 2) if self.requests else 0.0,
+            "max_ms": round(self.max_seconds * 1000, 2),
+        }
+
+
+class GoftinoClient:
+    """Application-lifetime client for the Goftino operator API."""
+
+    def __init__(self, api_key: str, operator_id: str):
+        self.api_key = api_key
+        self.operator_id = operator_id
+        self._client = None
+        self._stats = {name: EndpointStats() for name in ("send_message", "operator_typing", "transfer_chat")}
+        self._typing_state = {}  # chat_id -> (is_typing, monotonic time sent)
+        self._pending_off = {}   # chat_id -> task sending a debounced "off"
+
+    async def start(self):
+        limits = httpx.Limits(max_connections=GOFTINO_MAX_CONNECTIONS,
+                              max_keepalive_connections=GOFTINO_MAX_KEEPALIVE)
+        headers = {"Content-Type": "application/json", "goftino-key": self.api_key}
+        try:
+            self._client = httpx.AsyncClient(http2=True, limits=limits, timeout=GOFTINO_TIMEOUT, headers=headers)
+        except ImportError:
+            logging.warning("The h2 package is not installed; using HTTP/1.1 for Goftino.")
+            self._client = httpx.AsyncClient(limits=limits, timeout=GOFTINO_TIMEOUT, headers=headers)
+
+    async def close(self):
+        for task in self._pending_off.values():
+            task.cancel()
+        self._pending_off.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {name: stats.as_dict() for name, stats in self._stats.items()}
+
+    # -----------------------------------------------------------------
+    # Endpoints
+    # -----------------------------------------------------------------
+    async def send_message(self, chat_id: str, message: str):
+        payload = {"chat_id": chat_id, "message": message, "operator_id": self.operator_id}
+        # Goftino hides the typing indicator once a message arrives.
+        self._typing_state.pop(chat_id, None)
+        return await self._post("send_message", GOFTINO_SEND_API_URL, payload, idempotent=False)
+
+    async def transfer_chat(self, chat_id: str, from_operator: str, to_operator: str):
+        payload = {"chat_id": chat_id, "from_operator": from_operator, "to_operator": to_operator}
+        return await self._post("transfer_chat", GOFTINO_TRANSFER_API_URL, payload, idempotent=False)
+
+    async def set_typing(self, chat_id: str, is_typing: bool):
+        """Sets the typing status, skipping toggles that would not change anything.
+
+        An "off" is held back for GOFTINO_TYPING_DEBOUNCE seconds; if an "on"
+        arrives meanwhile, both are dropped and the indicator simply stays on.
+        """
+        pending = self._pending_off.pop(chat_id, None)
+        if pending is not None:
+            pending.cancel()
+        if is_typing:
+            state = self._typing_state.get(chat_id)
+            if state and state[0] and time.monotonic() - state[1] < GOFTINO_TYPING_REFRESH:
+                self._stats["operator_typing"].skipped += 1
+                return
+            await self._send_typing(chat_id, True)
+        elif chat_id in self._typing_state:
+            self._pending_off[chat_id] = asyncio.create_task(self._debounced_off(chat_id))
+        else:
+            self._stats["operator_typing"].skipped += 1
+
+    async def _debounced_off(self, chat_id: str):
+        await asyncio.sleep(GOFTINO_TYPING_DEBOUNCE)
+        self._pending_off.pop(chat_id, None)
+        if chat_id in self._typing_state:
+            await self._send_typing(chat_id, False)
+
+    async def _send_typing(self, chat_id: str, is_typing: bool):
+        payload = {"chat_id": chat_id, "operator_id": self.operator_id,
+                   "typing_status": "true" if is_typing else "false"}
+        if is_typing:
+            self._typing_state[chat_id] = (True, time.monotonic())
+        else:
+            self._typing_state.pop(chat_id, None)
+        await self._post("operator_typing", GOFTINO_TYPING_API_URL, payload)
+
+    # -----------------------------------------------------------------
+    # Transport
+    # -----------------------------------------------------------------
+    async def _post(self, endpoint: str, url: str, payload: dict, idempotent: bool = True):
+        """POSTs with retries on 5xx/429 and transport errors. Returns the response or None.
+
+        A request that is not idempotent is only retried if it never left
+        (UNSENT_ERRORS) or was refused (UNPROCESSED_STATUSES), so a reply is
+        not sent twice.
+        """
+        stats = self._stats[endpoint]
+        for attempt in range(GOFTINO_MAX_RETRIES + 1):
+            start = time.monotonic()
+            retry_after = None
+            try:
+                response = await self._client.post(url, json=payload)
+                retry_after = response.headers.get("retry-after")
+                response.raise_for_status()
+                return response
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                error = f"{status} - {e.response.text}"
+                retryable = status in UNPROCESSED_STATUSES or (idempotent and status >= 500)
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+                retryable = idempotent or isinstance(e, UNSENT_ERRORS)
+            finally:
+                elapsed = time.monotonic() - start
+                stats.requests += 1
+                stats.total_seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+
+            stats.errors += 1
+            if not retryable or attempt == GOFTINO_MAX_RETRIES:
+                logging.error(f"Goftino {endpoint} failed for chat {payload.get('chat_id')}: {error}")
+                return None
+            stats.retries += 1
+            delay = min(5.0, 0.25 * 2 ** attempt) * (0.5 + random.random())
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+            logging.warning(f"Goftino {endpoint} error ({error}), retrying in {delay:.2f}s.")
+            await asyncio.sleep(delay)
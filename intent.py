@@ -0,0 +1,305 @@
+# =================================================================
+# intent.py
+# Local, zero-network intent classification. A character n-gram
+# TF-IDF model is trained from data/intents.csv and scores a message
+# against each intent's centroid and its closest training example; it
+# answers in about a millisecond, and the LLM classifier is only
+# consulted when the local model is not confident. Confidence
+# thresholds are tuned per intent with `python intent.py eval`.
+#
+# Usage:
+#   python intent.py train            # build intent_model.json
+#   python intent.py eval             # leave-one-out accuracy report
+#   python intent.py predict "سلام"    # classify one message
+# =================================================================
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict
+
+INTENT_DATA_PATH = os.environ.get("INTENT_DATA_PATH", "data/intents.csv")
+INTENT_MODEL_PATH = os.environ.get("INTENT_MODEL_PATH", "intent_model.json")
+INTENT_ENGINE = os.environ.get("INTENT_ENGINE", "hybrid")            # "hybrid", "local" or "llm"
+INTENT_MIN_SCORE = float(os.environ.get("INTENT_MIN_SCORE", 0.30))   # Similarity to the best intent
+INTENT_MIN_MARGIN = float(os.environ.get("INTENT_MIN_MARGIN", 0.20)) # Lead over the best competing intent, for intents not in INTENT_MARGINS
+
+# The labels chatbot_response routes on
+LABELS = ("greeting", "faq", "complaint", "visitor_info", "chitchat", "unrelated", "unknown")
+
+# Intents that are handled the same way, so confusing them is not a reason to fall back
+EQUIVALENT_INTENTS = (("faq", "visitor_info"),)
+
+# Per-intent margins from the leave-one-out report (~95% accuracy on the messages each one accepts)
+INTENT_MARGINS = {"greeting": 0.12, "faq": 0.12, "visitor_info": 0.12, "chitchat": 0.16, "unknown": 0.12}
+
+# A wrong local guess here costs a logged complaint or a refusal to help, so the LLM always confirms them
+LLM_CONFIRMED_INTENTS = ("complaint", "unrelated")
+
+NGRAM_RANGE = (2, 4)
+
+_ARABIC_TO_PERSIAN = str.maketrans({
+    "ي": "ی", "ك": "ک", "ى": "ی", "ة": "ه", "ۀ": "ه", "أ": "ا", "إ": "ا", "آ": "ا",
+    "۰": "0", "۱": "1", "۲": "2", "۳": "3", "۴": "4", "۵": "5", "۶": "6", "۷": "7", "۸": "8", "۹": "9",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4", "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+    "‌": " ",
+})
+_NON_WORD = re.compile(r"[^\w\s]+")
+_DIACRITICS = re.compile(r"[ً-ٰٟ]")
+
+
+def normalize_text(text: str) -> str:
+    """Lower-cases and folds Arabic letters, digits, ZWNJ and punctuation."""
+    text = _DIACRITICS.sub("", text.lower().translate(_ARABIC_TO_PERSIAN))
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def normalize_label(label: str) -> str:
+    """Maps raw classifier output onto one of LABELS."""
+    label = label.strip().strip('"\'.-* ').lower()
+    if label.startswith("unrelated"):
+        return "unrelated"
+    return label if label in LABELS else "unknown"
+
+
+def extract_features(text: str) -> Counter:
+    """Word unigrams plus word-bounded character n-grams."""
+    features = Counter()
+    for word in normalize_text(text).split():
+        features["w:" + word] += 1
+        padded = f" {word} "
+        for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+            for i in range(len(padded) - n + 1):
+                features[padded[i:i + n]] += 1
+    return features
+
+
+def _unit(vector: dict) -> dict:
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    return {k: v / norm for k, v in vector.items()} if norm else {}
+
+
+# =================================================================
+# 1. LOCAL CLASSIFIER
+# =================================================================
+class CentroidClassifier:
+    """TF-IDF classifier over character n-grams. An intent's score averages the
+    similarity to its centroid and to its closest training example, so broad
+    intents (unrelated, chitchat) are not diluted into a weak centroid."""
+
+    def __init__(self, idf: dict, centroids: dict, examples=()):
+        self.idf = idf
+        self.centroids = centroids
+        self.examples = list(examples)  # (unit vector, label) per training example
+        self._postings = defaultdict(list)  # feature -> (example position, weight), for the nearest-example scan
+        for i, (vector, _) in enumerate(self.examples):
+            for f, v in vector.items():
+                self._postings[f].append((i, v))
+
+    @classmethod
+    def train(cls, examples):
+        """Trains from (text, label) pairs."""
+        docs = [(extract_features(text), label) for text, label in examples]
+        df = Counter()
+        for features, _ in docs:
+            df.update(features.keys())
+        n_docs = len(docs)
+        idf = {f: math.log((1 + n_docs) / (1 + count)) + 1 for f, count in df.items()}
+
+        sums = defaultdict(lambda: defaultdict(float))
+        vectors = []
+        for features, label in docs:
+            vector = _unit({f: (1 + math.log(c)) * idf[f] for f, c in features.items()})
+            for f, v in vector.items():
+                sums[label][f] += v
+            vectors.append((vector, label))
+        centroids = {label: _unit(vector) for label, vector in sums.items()}
+        return cls(idf, centroids, vectors)
+
+    def vectorize(self, text: str) -> dict:
+        features = extract_features(text)
+        return _unit({f: (1 + math.log(c)) * self.idf[f] for f, c in features.items() if f in self.idf})
+
+    def scores(self, text: str) -> dict:
+        """Similarity of the text to every intent: mean of the centroid and nearest-example cosines."""
+        vector = self.vectorize(text)
+        scores = {
+            label: sum(v * centroid.get(f, 0.0) for f, v in vector.items())
+            for label, centroid in self.centroids.items()
+        }
+        if not self.examples:
+            return scores
+        similarity = [0.0] * len(self.examples)
+        for f, v in vector.items():
+            for i, w in self._postings.get(f, ()):
+                similarity[i] += v * w
+        nearest = dict.fromkeys(scores, 0.0)
+        for (_, label), sim in zip(self.examples, similarity):
+            if sim > nearest[label]:
+                nearest[label] = sim
+        return {label: (score + nearest[label]) / 2 for label, score in scores.items()}
+
+    def predict(self, text: str):
+        """Returns (label, score, margin) for the best matching intent."""
+        scores = self.scores(text)
+        if not scores:
+            return "unknown", 0.0, 0.0
+        label = max(scores, key=scores.get)
+        equivalent = next((group for group in EQUIVALENT_INTENTS if label in group), (label,))
+        runner_up = max((s for l, s in scores.items() if l not in equivalent), default=0.0)
+        return label, scores[label], scores[label] - runner_up
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"version": 2, "ngram_range": NGRAM_RANGE, "idf": self.idf, "centroids": self.centroids,
+                       "examples": self.examples}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding="utf-8") as f:
+            model = json.load(f)
+        return cls(model["idf"], model["centroids"], [tuple(e) for e in model.get("examples", ())])
+
+
+def is_confident(label: str, score: float, margin: float, min_score: float = INTENT_MIN_SCORE,
+                 min_margin: float = INTENT_MIN_MARGIN, margins: dict = INTENT_MARGINS) -> bool:
+    """Whether a local prediction is trusted without asking the LLM."""
+    if label in LLM_CONFIRMED_INTENTS:
+        return False
+    return score >= min_score and margin >= margins.get(label, min_margin)
+
+
+def load_examples(path: str = INTENT_DATA_PATH):
+    """Reads labelled (text, intent) pairs from a CSV file."""
+    with open(path, newline="", encoding="utf-8") as f:
+        return [(row["text"], row["intent"]) for row in csv.DictReader(f) if row["text"].strip()]
+
+
+def load_classifier(model_path: str = INTENT_MODEL_PATH, data_path: str = INTENT_DATA_PATH):
+    """Loads the saved model, training one from the examples if it is missing."""
+    if os.path.exists(model_path):
+        return CentroidClassifier.load(model_path)
+    if os.path.exists(data_path):
+        return CentroidClassifier.train(load_examples(data_path))
+    return None
+
+
+# =================================================================
+# 2. INTENT ENGINE
+# =================================================================
+class IntentEngine:
+    """Local-first intent detection with an optional LLM fallback.
+
+    `llm_classify` / `allm_classify` take the user input and return the raw
+    LLM label; they are used in "llm" mode, and in "hybrid" mode whenever
+    the local classifier is below the score or margin threshold.
+    """
+
+    def __init__(self, classifier=None, llm_classify=None, allm_classify=None, mode: str = INTENT_ENGINE,
+                 min_score: float = INTENT_MIN_SCORE, min_margin: float = INTENT_MIN_MARGIN):
+        self.classifier = classifier
+        self.llm_classify = llm_classify
+        self.allm_classify = allm_classify
+        self.mode = mode if classifier is not None else "llm"
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.local_count = 0
+        self.fallback_count = 0
+
+    def _local(self, text: str):
+        """Returns the local label, or None if the LLM should decide."""
+        if self.mode == "llm":
+            return None
+        label, score, margin = self.classifier.predict(text)
+        confident = is_confident(label, score, margin, self.min_score, self.min_margin)
+        if self.mode == "local" or confident:
+            self.local_count += 1
+            return label
+        if self.llm_classify is None and self.allm_classify is None:
+            self.local_count += 1
+            return label
+        return None
+
+    def detect(self, text: str) -> str:
+        label = self._local(text)
+        if label is not None:
+            return label
+        self.fallback_count += 1
+        return normalize_label(self.llm_classify(text))
+
+    async def adetect(self, text: str) -> str:
+        label = self._local(text)
+        if label is not None:
+            return label
+        self.fallback_count += 1
+        return normalize_label(await self.allm_classify(text))
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "local": self.local_count, "llm_fallback": self.fallback_count}
+
+
+# =================================================================
+# 3. OFFLINE TRAINING / EVALUATION
+# =================================================================
+def evaluate(examples, min_score: float = INTENT_MIN_SCORE, min_margin: float = INTENT_MIN_MARGIN):
+    """Leave-one-out evaluation of the local classifier."""
+    correct = confident = confident_correct = 0
+    per_label = defaultdict(lambda: [0, 0])
+    errors = []
+    for i, (text, label) in enumerate(examples):
+        classifier = CentroidClassifier.train(examples[:i] + examples[i + 1:])
+        predicted, score, margin = classifier.predict(text)
+        group = next((g for g in EQUIVALENT_INTENTS if label in g), (label,))
+        hit = predicted in group
+        correct += hit
+        per_label[label][0] += hit
+        per_label[label][1] += 1
+        if is_confident(predicted, score, margin, min_score, min_margin):
+            confident += 1
+            confident_correct += hit
+        if not hit:
+            errors.append((text, label, predicted, score, margin))
+
+    classifier = CentroidClassifier.train(examples)
+    start = time.perf_counter()
+    for text, _ in examples:
+        classifier.predict(text)
+    latency_ms = (time.perf_counter() - start) * 1000 / len(examples)
+
+    total = len(examples)
+    print(f"Examples: {total}")
+    print(f"Accuracy (all): {correct / total:.1%}")
+    print(f"Handled locally: {confident / total:.1%} "
+          f"(accuracy {confident_correct / max(confident, 1):.1%}), LLM fallback: {1 - confident / total:.1%}")
+    print(f"Mean latency: {latency_ms:.3f} ms")
+    for label, (hits, count) in sorted(per_label.items()):
+        print(f"  {label:<14} {hits}/{count}")
+    for text, label, predicted, score, margin in errors:
+        print(f"  miss: {text!r} expected={label} got={predicted} score={score:.2f} margin={margin:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and evaluate the local intent classifier.")
+    parser.add_argument("command", choices=["train", "eval", "predict"])
+    parser.add_argument("text", nargs="?", help="Message to classify (predict only)")
+    parser.add_argument("--data", default=INTENT_DATA_PATH)
+    parser.add_argument("--model", default=INTENT_MODEL_PATH)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        examples = load_examples(args.data)
+        CentroidClassifier.train(examples).save(args.model)
+        print(f"Trained on {len(examples)} examples and saved the model to {args.model}")
+    elif args.command == "eval":
+        evaluate(load_examples(args.data))
+    else:
+        classifier = load_classifier(args.model, args.data)
+        label, score, margin = classifier.predict(args.text or "")
+        print(f"{label} (score={score:.3f}, margin={margin:.3f})")
+
+
+if __name__ == "__main__":
+    main()
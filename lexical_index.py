@@ -0,0 +1,146 @@
+# =================================================================
+# lexical_index.py
+# BM25 inverted index over the same chunks as faiss_index. embedder.py
+# saves it next to the FAISS files and chatbot.py fuses its ranking
+# with the dense one by reciprocal-rank fusion. Exact lookups (branch
+# names, course codes, phone numbers) are matched reliably this way,
+# and when the lexical hit is unambiguous the query embedding is not
+# needed at all. Text goes through intent.normalize_text, which folds
+# Arabic yeh/kaf, ZWNJ, diacritics and Persian/Arabic digits.
+#
+# Usage:
+#   python lexical_index.py search "آدرس شعبه ولیعصر"
+# =================================================================
+import argparse
+import json
+import math
+import os
+import pickle
+from collections import Counter, defaultdict
+
+from intent import normalize_text
+
+LEXICAL_FILE = "lexical.json"
+
+BM25_K1 = float(os.environ.get("BM25_K1", 1.2))
+BM25_B = float(os.environ.get("BM25_B", 0.75))
+RRF_K = int(os.environ.get("RRF_K", 60))                                             # Rank offset in reciprocal-rank fusion
+LEXICAL_CONFIDENT_COVERAGE = float(os.environ.get("LEXICAL_CONFIDENT_COVERAGE", 1.0)) # Share of the query's IDF weight the top chunk must contain
+HYBRID_RETRIEVAL = os.environ.get("HYBRID_RETRIEVAL", "1") == "1"                   # Fuse BM25 with dense search, "0" for dense only
+LEXICAL_SKIP_EMBEDDING = os.environ.get("LEXICAL_SKIP_EMBEDDING", "1") == "1"       # Answer from BM25 alone when it is confident
+HYBRID_FETCH_K = int(os.environ.get("HYBRID_FETCH_K", 12))                           # Candidates taken from each ranking before fusion
+LEXICAL_CONFIDENT_RATIO = float(os.environ.get("LEXICAL_CONFIDENT_RATIO", 1.5))       # Lead of the top BM25 score over the runner-up
+LEXICAL_CONFIDENT_MIN_TERMS = int(os.environ.get("LEXICAL_CONFIDENT_MIN_TERMS", 2))  # Single-word queries always get the dense tier too
+
+
+def tokenize(text: str):
+    return normalize_text(text).split()
+
+
+class LexicalIndex:
+    """Okapi BM25 over chunk texts, keyed by their docstore ids."""
+
+    def __init__(self, ids, doc_lengths, postings, k1: float = BM25_K1, b: float = BM25_B):
+        self.ids = ids                  # position -> docstore id
+        self.doc_lengths = doc_lengths  # position -> number of tokens
+        self.postings = postings        # term -> [[position, term frequency], ...]
+        self.k1 = k1
+        self.b = b
+        self._positions = {doc_id: position for position, doc_id in enumerate(ids)}
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+        n = len(ids)
+        self.idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in postings.items()}
+        # Weight given to query terms the corpus has never seen
+        self.max_idf = math.log(1 + (n + 0.5) / 0.5)
+
+    @classmethod
+    def build(cls, ids, texts, k1: float = BM25_K1, b: float = BM25_B) -> "LexicalIndex":
+        postings = defaultdict(list)
+        doc_lengths = []
+        for position, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings[term].append([position, tf])
+        return cls(list(ids), doc_lengths, dict(postings), k1, b)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore) -> "LexicalIndex":
+        """Builds the index from a loaded FAISS store, for indexes saved without lexical.json."""
+        ids = [vectorstore.index_to_docstore_id[i] for i in range(len(vectorstore.index_to_docstore_id))]
+        return cls.build(ids, [vectorstore.docstore.search(doc_id).page_content for doc_id in ids])
+
+    def save(self, path: str):
+        with open(os.path.join(path, LEXICAL_FILE), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "ids": self.ids, "doc_lengths": self.doc_lengths,
+                       "postings": self.postings}, f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads lexical.json from an index directory, or returns None if there is none."""
+        file_path = os.path.join(path, LEXICAL_FILE)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["doc_lengths"], data["postings"], data["k1"], data["b"])
+
+    def search(self, query: str, k: int):
+        """Returns up to k (docstore id, score) pairs, best first."""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, tf in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[position] / self.avg_length)
+                scores[position] += idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.ids[position], score) for position, score in best]
+
+    def confident(self, query: str, hits, coverage: float = LEXICAL_CONFIDENT_COVERAGE,
+                  ratio: float = LEXICAL_CONFIDENT_RATIO, min_terms: int = LEXICAL_CONFIDENT_MIN_TERMS) -> bool:
+        """True when the top hit contains (nearly) every query term and clearly beats the runner-up."""
+        terms = set(tokenize(query))
+        if not hits or len(terms) < min_terms:
+            return False
+        top = self._positions[hits[0][0]]
+        weight = sum(self.idf.get(t, self.max_idf) for t in terms)
+        matched = sum(self.idf[t] for t in terms if t in self.idf and any(p == top for p, _ in self.postings[t]))
+        if matched < coverage * weight:
+            return False
+        return len(hits) == 1 or hits[0][1] >= ratio * hits[1][1]
+
+
+def reciprocal_rank_fusion(rankings, k: int = RRF_K):
+    """Fuses ranked lists of keys. Returns the keys ordered by summed 1 / (k + rank)."""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            scores[key] += 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the BM25 index saved next to faiss_index.")
+    parser.add_argument("command", choices=["search"])
+    parser.add_argument("query")
+    parser.add_argument("--path", default="faiss_index")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    index = LexicalIndex.load(args.path)
+    if index is None:
+        print(f"❌ Error: no {LEXICAL_FILE} in {args.path}. Run embedder.py first.")
+        return
+    with open(os.path.join(args.path, "index.pkl"), "rb") as f:
+        docstore, _ = pickle.load(f)
+    hits = index.search(args.query, args.k)
+    print(f"confident: {index.confident(args.query, hits)}")
+    for doc_id, score in hits:
+        text = " ".join(docstore.search(doc_id).page_content.split())
+        print(f"{score:8.3f}  {text[:100]}")
+
+
+if __name__ == "__main__":
+    main()
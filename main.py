@@ -3,11 +3,16 @@
 # =================================================================
 import uvicorn
 import os
-import httpx
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from chatbot import chatbot_response
+from chatbot import chatbot_response, achatbot_response, astream_chatbot_response, answer_cache, intent_engine, engine
+from dispatcher import ChatDispatcher
+from dedup import MessageDeduplicator, message_key
+from goftino import GoftinoClient
+from metrics import REGISTRY, WEBHOOKS, profiler, span
 
 # Configure logging to provide detailed output
 logging.basicConfig(
@@ -18,10 +23,52 @@ logging.basicConfig(
 # =================================================================
 # 1. APP INITIALIZATION & CONFIGURATION
 # =================================================================
+# Pipeline worker pool configuration
+CHATBOT_WORKERS = int(os.environ.get("CHATBOT_WORKERS", 4))                  # Concurrent pipeline runs
+CHATBOT_QUEUE_SIZE = int(os.environ.get("CHATBOT_QUEUE_SIZE", 100))          # Messages waiting before we shed load
+CHATBOT_PER_CHAT_LIMIT = int(os.environ.get("CHATBOT_PER_CHAT_LIMIT", 1))    # Concurrent runs per chat_id
+CHATBOT_EXECUTOR_THREADS = int(os.environ.get("CHATBOT_EXECUTOR_THREADS", CHATBOT_WORKERS))
+CHATBOT_COALESCE_WINDOW = float(os.environ.get("CHATBOT_COALESCE_WINDOW", 0))  # Extra quiet seconds to wait for a chat's next message; at 0 only messages arriving while its run is queued or in flight are merged
+CHATBOT_COALESCE_MAX_MESSAGES = int(os.environ.get("CHATBOT_COALESCE_MAX_MESSAGES", 10))  # Messages merged into one run before the chat's next run is queued
+CHATBOT_COALESCE_MAX_CHARS = int(os.environ.get("CHATBOT_COALESCE_MAX_CHARS", 4000))    # Characters merged into one run before the chat's next run is queued
+CHATBOT_PIPELINE = os.environ.get("CHATBOT_PIPELINE", "async")               # "async" (ainvoke) or "executor"
+CHATBOT_STREAMING = os.environ.get("CHATBOT_STREAMING", "0") == "1"          # "1" sends answers segment by segment (async pipeline only)
+STREAM_TYPING_INTERVAL = float(os.environ.get("STREAM_TYPING_INTERVAL", 1.0)) # Seconds between typing keep-alive checks
+INDEX_RELOAD_INTERVAL = float(os.environ.get("INDEX_RELOAD_INTERVAL", 30))   # Seconds between faiss_index change checks, 0 disables
+
+SHED_LOAD_MESSAGE = "در حال حاضر تعداد پیام‌ها زیاد است. لطفاً چند دقیقه دیگر دوباره پیام بدهید."
+
+
+async def watch_index():
+    """Hot-reloads faiss_index when embedder.py has rebuilt it."""
+    while True:
+        await asyncio.sleep(INDEX_RELOAD_INTERVAL)
+        try:
+            await asyncio.to_thread(engine.reload_if_changed)
+        except Exception as e:
+            logging.error(f"Index reload failed: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Models and the index load in the background; /ready reports when they are up.
+    engine.warmup()
+    await goftino.start()
+    await dispatcher.start()
+    watcher = asyncio.create_task(watch_index()) if INDEX_RELOAD_INTERVAL > 0 else None
+    yield
+    if watcher is not None:
+        watcher.cancel()
+    await dispatcher.stop()
+    await goftino.close()
+    await asyncio.to_thread(engine.complaints.close)
+
+
 app = FastAPI(
     title="Chatbot API for Goftino",
     description="An API for a stateless chatbot with automated transfer to/from human operators.",
-    version="10.0.0"
+    version="10.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -41,10 +88,8 @@ GOFTINO_API_KEY = os.environ.get("GOFTINO_API_KEY", "YOUR_GOFTINO_API_KEY")
 BOT_OPERATOR_ID = os.environ.get("GOFTINO_OPERATOR_ID", "YOUR_BOT_OPERATOR_ID")  # The Chatbot's Operator ID
 HUMAN_OPERATOR_ID = "687c9153c7b2788949dda73c"      # The Human Operator's ID
 
-# API URLs
-GOFTINO_SEND_API_URL = "https://api.goftino.com/v1/send_message"
-GOFTINO_TYPING_API_URL = "https://api.goftino.com/v1/operator_typing"
-GOFTINO_TRANSFER_API_URL = "https://api.goftino.com/v1/transfer_chat"
+# Shared client for all Goftino API calls; opened and closed in lifespan()
+goftino = GoftinoClient(GOFTINO_API_KEY, BOT_OPERATOR_ID)
 
 
 # =================================================================
@@ -55,39 +100,96 @@ async def transfer_chat(chat_id: str, from_operator: str, to_operator: str):
     if not all([GOFTINO_API_KEY, from_operator, to_operator]):
         logging.error("API Key, from_operator, or to_operator ID is missing for transfer!")
         return
-    headers = {"Content-Type": "application/json", "goftino-key": GOFTINO_API_KEY}
-    payload = {"chat_id": chat_id, "from_operator": from_operator, "to_operator": to_operator} # Corrected payload
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(GOFTINO_TRANSFER_API_URL, json=payload, headers=headers)
-            response.raise_for_status()
-            logging.info(f"Successfully initiated transfer for chat {chat_id} from {from_operator} to {to_operator}.")
-        except httpx.HTTPStatusError as e:
-            logging.error(f"Error transferring chat: {e.response.status_code} - {e.response.text}")
+    with span("goftino_transfer"):
+        result = await goftino.transfer_chat(chat_id, from_operator, to_operator)
+    if result is not None:
+        logging.info(f"Successfully initiated transfer for chat {chat_id} from {from_operator} to {to_operator}.")
 
 async def set_typing_status(chat_id: str, is_typing: bool):
     """Sets the bot's typing status in the chat."""
     if not all([GOFTINO_API_KEY, BOT_OPERATOR_ID]): return
-    headers = {"Content-Type": "application/json", "goftino-key": GOFTINO_API_KEY}
-    payload = {"chat_id": chat_id, "operator_id": BOT_OPERATOR_ID, "typing_status": "true" if is_typing else "false"}
-    async with httpx.AsyncClient() as client:
-        try:
-            await client.post(GOFTINO_TYPING_API_URL, json=payload, headers=headers)
-        except httpx.HTTPStatusError as e:
-            logging.error(f"Error setting typing status: {e.response.status_code}")
+    with span("goftino_typing"):
+        await goftino.set_typing(chat_id, is_typing)
 
 async def send_reply_to_goftino(chat_id: str, message: str):
     """Sends a message from the bot to the user via Goftino."""
     if not all([GOFTINO_API_KEY, BOT_OPERATOR_ID]): return
-    headers = {"Content-Type": "application/json", "goftino-key": GOFTINO_API_KEY}
-    payload = {"chat_id": chat_id, "message": message, "operator_id": BOT_OPERATOR_ID}
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(GOFTINO_SEND_API_URL, json=payload, headers=headers)
-            response.raise_for_status()
-            logging.info(f"Sent message to chat {chat_id}: '{message}'")
-        except httpx.HTTPStatusError as e:
-            logging.error(f"Error sending message to Goftino: {e.response.status_code} - {e.response.text}")
+    with span("goftino_send"):
+        result = await goftino.send_message(chat_id, message)
+    if result is not None:
+        logging.info(f"Sent message to chat {chat_id}: '{message}'")
+
+async def transfer_to_human(chat_id: str):
+    """Tells the user they are being transferred, then hands the chat to the human operator."""
+    logging.info(f"Bot returned -1. Transferring chat {chat_id} to human operator: {HUMAN_OPERATOR_ID}.")
+
+    preamble_message = "متوجه شدم. لطفاً چند لحظه صبر کنید تا شما را به یک اپراتور انسانی وصل کنم."
+    await send_reply_to_goftino(chat_id, preamble_message)
+    await transfer_chat(chat_id, from_operator=BOT_OPERATOR_ID, to_operator=HUMAN_OPERATOR_ID)
+
+async def keep_typing(chat_id: str):
+    """Keeps the typing indicator on while an answer is still being generated.
+
+    Goftino clears the indicator whenever a message is sent, so this puts it
+    back between segments; unchanged "on" states are skipped by the client.
+    """
+    while True:
+        await set_typing_status(chat_id, is_typing=True)
+        await asyncio.sleep(STREAM_TYPING_INTERVAL)
+
+async def process_message_streaming(chat_id: str, user_message: str):
+    """Runs the streaming pipeline and sends each answer segment as soon as it is complete."""
+    typing = asyncio.create_task(keep_typing(chat_id))
+    try:
+        async for segment in astream_chatbot_response(user_message, chat_id):
+            if segment == -1:
+                typing.cancel()
+                await transfer_to_human(chat_id)
+                return
+            await send_reply_to_goftino(chat_id, segment)
+    finally:
+        typing.cancel()
+        await set_typing_status(chat_id, is_typing=False)
+
+async def process_message(chat_id: str, user_message: str):
+    """Runs the chatbot pipeline for one message; a sample of slow runs is profiled (see metrics.py)."""
+    with profiler.profile(f"chat-{chat_id}"), span("process_message"):
+        await deliver_response(chat_id, user_message)
+
+async def deliver_response(chat_id: str, user_message: str):
+    """Runs the chatbot pipeline for one message and delivers the result."""
+    if CHATBOT_STREAMING and CHATBOT_PIPELINE != "executor":
+        return await process_message_streaming(chat_id, user_message)
+
+    await set_typing_status(chat_id, is_typing=True)
+    try:
+        if CHATBOT_PIPELINE == "executor":
+            response_text = await dispatcher.run_blocking(chatbot_response, user_message, chat_id)
+        else:
+            response_text = await achatbot_response(user_message, chat_id)
+    finally:
+        await set_typing_status(chat_id, is_typing=False)
+
+    if response_text == -1:
+        await transfer_to_human(chat_id)
+    else:
+        await send_reply_to_goftino(chat_id, response_text)
+
+
+dispatcher = ChatDispatcher(
+    process_message,
+    workers=CHATBOT_WORKERS,
+    queue_size=CHATBOT_QUEUE_SIZE,
+    per_chat_limit=CHATBOT_PER_CHAT_LIMIT,
+    executor_threads=CHATBOT_EXECUTOR_THREADS,
+    coalesce_window=CHATBOT_COALESCE_WINDOW,
+    coalesce_max_messages=CHATBOT_COALESCE_MAX_MESSAGES,
+    coalesce_max_chars=CHATBOT_COALESCE_MAX_CHARS,
+)
+
+# Drops Goftino's redeliveries of messages we have already accepted
+dedup = MessageDeduplicator()
+
 
 # =================================================================
 # 3. MAIN WEBHOOK ENDPOINT (REVISED LOGIC)
@@ -95,14 +197,16 @@ async def send_reply_to_goftino(chat_id: str, message: str):
 @app.post("/chat/")
 async def chat_webhook(request: Request, background_tasks: BackgroundTasks):
     webhook_data = await request.json()
-    logging.info(f"Received webhook: {webhook_data}")
-
     event = webhook_data.get("event")
     data = webhook_data.get("data", {})
     chat_id = data.get("chat_id")
-    
+    # Only a summary is logged; message bodies carry visitors' personal details.
+    logging.info(f"Received webhook: event={event} chat_id={chat_id} type={data.get('type')} "
+                 f"chars={len(data.get('content') or '')}")
+
     if not chat_id:
         logging.warning("Webhook received without a chat_id.")
+        WEBHOOKS.inc(event=event, outcome="no_chat_id")
         return Response(status_code=204)
 
     # Handle new messages from the user
@@ -111,36 +215,103 @@ async def chat_webhook(request: Request, background_tasks: BackgroundTasks):
         current_operator_id = data.get("operator_id") # This will be None for new chats
 
         if not user_message or data.get("type") != "text":
+            WEBHOOKS.inc(event=event, outcome="ignored")
             return Response(status_code=204)
 
         # --- THIS IS THE KEY LOGIC CHANGE ---
         # The bot should NOT intervene ONLY IF an operator is assigned AND that operator is NOT the bot.
         if current_operator_id and current_operator_id != BOT_OPERATOR_ID:
             logging.info(f"Chat {chat_id} is assigned to human operator {current_operator_id}. Bot will not intervene.")
+            WEBHOOKS.inc(event=event, outcome="human_operator")
             return Response(status_code=204)
 
-        # If the code reaches here, it means the chat is new (operator is None) or assigned to the bot.
-        logging.info(f"Bot ({BOT_OPERATOR_ID}) is processing message for chat {chat_id}: '{user_message}'")
-        
-        await set_typing_status(chat_id, is_typing=True)
-        response_text = chatbot_response(user_message)
-        await set_typing_status(chat_id, is_typing=False)
+        # Goftino retries webhooks it thinks timed out; each message is answered only once.
+        if await dedup.aseen(message_key(data)):
+            logging.info(f"Duplicate webhook for chat {chat_id} ignored.")
+            WEBHOOKS.inc(event=event, outcome="duplicate")
+            return Response(status_code=204)
 
-        if response_text == -1:
-            logging.info(f"Bot returned -1. Transferring chat {chat_id} to human operator: {HUMAN_OPERATOR_ID}.")
-            
-            preamble_message = "متوجه شدم. لطفاً چند لحظه صبر کنید تا شما را به یک اپراتور انسانی وصل کنم."
-            background_tasks.add_task(send_reply_to_goftino, chat_id, preamble_message)
-            background_tasks.add_task(transfer_chat, chat_id, from_operator=BOT_OPERATOR_ID, to_operator=HUMAN_OPERATOR_ID)
+        # If the code reaches here, it means the chat is new (operator is None) or assigned to the bot.
+        # The pipeline runs on the dispatcher's workers so the webhook is acknowledged right away.
+        if dispatcher.submit(chat_id, user_message):
+            logging.info(f"Bot ({BOT_OPERATOR_ID}) queued message for chat {chat_id} ({len(user_message)} chars)")
+            WEBHOOKS.inc(event=event, outcome="queued")
         else:
-            background_tasks.add_task(send_reply_to_goftino, chat_id, response_text)
+            logging.warning(f"Dispatcher queue is full. Shedding message for chat {chat_id}.")
+            WEBHOOKS.inc(event=event, outcome="shed")
+            background_tasks.add_task(send_reply_to_goftino, chat_id, SHED_LOAD_MESSAGE)
+        return Response(status_code=204)
 
+    WEBHOOKS.inc(event=event, outcome="ignored")
     return Response(status_code=204)
 
 @app.get("/")
 def read_root():
     return {"status": "ok", "message": "Iran-Australia Chatbot is running."}
 
+@app.get("/ready")
+def read_ready(response: Response):
+    status = engine.status()
+    if not status["ready"]:
+        response.status_code = 503
+    return status
+
+@app.get("/stats")
+def read_stats():
+    return {
+        "dispatcher": dispatcher.stats(),
+        "dedup": dedup.stats(),
+        "intent": intent_engine.stats(),
+        "answer_cache": answer_cache.stats(),
+        "goftino": goftino.stats(),
+        "complaints": engine.complaints.stats(),
+        "sessions": engine.sessions.stats(),
+        "tokens": engine.usage.stats(),
+    }
+
+@REGISTRY.collector
+def component_metrics():
+    """Exports the counters the components already keep, read at scrape time."""
+    cache = answer_cache.stats()
+    queue = dispatcher.stats()
+    complaints = engine.complaints.stats()
+    sessions = engine.sessions.stats()
+    samples = [
+        ("chatbot_answer_cache_lookups_total", "counter", "Answer cache lookups by result.", {"result": "hit"},
+         cache["hits"] - cache["semantic_hits"]),
+        ("chatbot_answer_cache_lookups_total", "counter", "Answer cache lookups by result.", {"result": "semantic_hit"},
+         cache["semantic_hits"]),
+        ("chatbot_answer_cache_lookups_total", "counter", "Answer cache lookups by result.", {"result": "miss"},
+         cache["misses"]),
+        ("chatbot_answer_cache_entries", "gauge", "Answers held in the cache.", {}, cache["entries"]),
+        ("chatbot_queue_depth", "gauge", "Messages waiting for a pipeline worker.", {}, queue["queued"]),
+        ("chatbot_active_chats", "gauge", "Chats with a pipeline run queued or in progress.", {}, queue["active_chats"]),
+        ("chatbot_shed_total", "counter", "Messages shed because the queue was full.", {}, queue["shed"]),
+        ("chatbot_coalesced_total", "counter", "Messages merged into a run already queued for their chat.", {},
+         queue["coalesced"]),
+        ("chatbot_sessions", "gauge", "Sessions held in memory.", {}, sessions["sessions"]),
+        ("chatbot_complaints_written_total", "counter", "Complaints written to the store.", {}, complaints["written"]),
+        ("chatbot_complaints_dropped_total", "counter", "Complaints dropped or failed.", {},
+         complaints["dropped"] + complaints["failed"]),
+    ]
+    for source, count in intent_engine.stats().items():
+        if source != "mode":
+            samples.append(("chatbot_intent_detections_total", "counter", "Intent detections by classifier.",
+                            {"classifier": source}, count))
+    for endpoint, stats in goftino.stats().items():
+        for key in ("requests", "errors", "retries", "skipped"):
+            samples.append((f"chatbot_goftino_{key}_total", "counter", f"Goftino API {key} by endpoint.",
+                            {"endpoint": endpoint}, stats[key]))
+    for kind, totals in engine.usage.stats().items():
+        for key in ("prompt_tokens", "completion_tokens", "cached_prompt_tokens"):
+            samples.append((f"chatbot_llm_{key}_total", "counter", f"LLM {key.replace('_', ' ')} by call kind.",
+                            {"kind": kind}, totals[key]))
+    return samples
+
+@app.get("/metrics")
+def read_metrics():
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 # =================================================================
 # 4. RUN THE APPLICATION
 # =================================================================
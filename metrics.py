@@ -0,0 +1,222 @@
+# =================================================================
+# metrics.py
+# Minimal Prometheus-style metrics: counters and histograms with
+# labels, per-stage timing spans, collectors that export the stats the
+# other components already keep, and the text exposition format served
+# on /metrics. Also an optional sampled cProfile hook that keeps the
+# profile of requests slower than a threshold.
+# =================================================================
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))      # Share of requests profiled, 0 disables
+PROFILE_SLOW_SECONDS = float(os.environ.get("PROFILE_SLOW_SECONDS", 5))    # Profiles of faster requests are discarded
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")                            # Save .prof files here; empty logs the top functions instead
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_label_text(self.labels, key)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + ("le",)
+        for key, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket{_label_text(names, key + (bound,))} {count}"
+            yield f"{self.name}_bucket{_label_text(names, key + ('+Inf',))} {series[-2]}"
+            yield f"{self.name}_count{_label_text(self.labels, key)} {series[-2]}"
+            yield f"{self.name}_sum{_label_text(self.labels, key)} {series[-1]:.6f}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help_text: str, labels=()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Registers func() -> [(name, type, help, {labels}, value)], evaluated at scrape time."""
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        families = {}  # name -> (type, help, sample lines); the format wants each family contiguous
+        for func in self._collectors:
+            try:
+                samples = func()
+            except Exception as e:
+                logging.error(f"Metrics collector {func.__name__} failed: {e}")
+                continue
+            for name, kind, help_text, labels, value in samples:
+                family = families.setdefault(name, (kind, help_text, []))
+                family[2].append(f"{name}{_label_text(tuple(labels), tuple(labels.values()))} {value}")
+        for name, (kind, help_text, samples) in families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("chatbot_stage_seconds", "Time spent per pipeline stage.", ("stage",))
+RESPONSE_SECONDS = REGISTRY.histogram("chatbot_response_seconds", "Chatbot pipeline time per message.",
+                                      ("pipeline", "intent"))
+MESSAGES = REGISTRY.counter("chatbot_messages_total", "Messages answered by the chatbot pipeline.", ("intent",))
+ERRORS = REGISTRY.counter("chatbot_errors_total", "Exceptions raised inside a stage.", ("stage", "error_type"))
+WEBHOOKS = REGISTRY.counter("chatbot_webhooks_total", "Goftino webhooks received.", ("event", "outcome"))
+
+
+@contextmanager
+def span(stage: str):
+    """Times a block into chatbot_stage_seconds and counts the exceptions it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        ERRORS.inc(stage=stage, error_type=type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed(stage: str):
+    """Decorator form of span() for plain and async functions."""
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# =================================================================
+# SAMPLED PROFILING
+# =================================================================
+class SlowRequestProfiler:
+    """Profiles a sample of requests and keeps the profiles of the slow ones.
+
+    cProfile sees the whole thread, so the profile of an async request
+    also contains whatever other tasks ran on the event loop meanwhile.
+    Only one request is profiled at a time.
+    """
+
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE, slow_seconds: float = PROFILE_SLOW_SECONDS,
+                 output_dir: str = PROFILE_DIR):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.output_dir = output_dir
+        self._active = threading.Lock()
+        self.kept = 0
+
+    @contextmanager
+    def profile(self, label: str):
+        if not self.sample_rate or random.random() >= self.sample_rate or not self._active.acquire(blocking=False):
+            yield
+            return
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+            yield
+        finally:
+            profiler.disable()
+            self._active.release()
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.slow_seconds:
+                self._keep(profiler, label, elapsed)
+
+    def _keep(self, profiler, label: str, elapsed: float):
+        self.kept += 1
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{label}.prof")
+            profiler.dump_stats(path)
+            logging.warning(f"Slow request {label} took {elapsed:.2f}s; profile saved to {path}")
+            return
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(25)
+        logging.warning(f"Slow request {label} took {elapsed:.2f}s; profile:\n{out.getvalue()}")
+
+
+profiler = SlowRequestProfiler()
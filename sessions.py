@@ -0,0 +1,203 @@
+# =================================================================
+# sessions.py
+# Per-chat_id conversation state: the visitor's collected details and
+# a compacted rolling history used as context in prompts. Sessions
+# live in an LRU/TTL-bounded in-memory tier; with SESSION_BACKEND=sqlite
+# they are also written through to a SQLite file, so several uvicorn
+# workers (or a restart) see the same conversation.
+#
+# History is bounded per session: each stored message is truncated,
+# only the last SESSION_HISTORY_TURNS turns are kept verbatim, and
+# older turns are folded into a short extractive summary.
+# =================================================================
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")                # "memory" or "sqlite"
+SESSION_PATH = os.environ.get("SESSION_PATH", "sessions.db")
+SESSION_MAX_SESSIONS = int(os.environ.get("SESSION_MAX_SESSIONS", 10000))    # In-memory sessions before LRU eviction
+SESSION_TTL = float(os.environ.get("SESSION_TTL", 24 * 3600))                # Seconds of inactivity before a session is dropped
+SESSION_HISTORY_TURNS = int(os.environ.get("SESSION_HISTORY_TURNS", 4))      # Recent turns kept verbatim
+SESSION_MESSAGE_CHARS = int(os.environ.get("SESSION_MESSAGE_CHARS", 400))    # Longer messages are truncated in the history
+SESSION_SUMMARY_CHARS = int(os.environ.get("SESSION_SUMMARY_CHARS", 600))    # Cap on the summary of older turns
+SESSION_SUMMARY_ITEM_CHARS = 80                                              # Per-turn budget inside the summary
+
+_SENTENCE_END = re.compile(r"[.!?؟\n]")
+
+
+def _truncate(text: str, limit: int) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+def _first_sentence(text: str, limit: int) -> str:
+    match = _SENTENCE_END.search(text)
+    return _truncate(text[:match.start()] if match and match.start() > 0 else text, limit)
+
+
+class Session:
+    """State of one conversation."""
+
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.name = None
+        self.phone_number = None
+        self.info_collected = False
+        self.turns = []     # [user message, bot reply] pairs, oldest first
+        self.summary = ""   # Compacted older turns
+        self.updated = time.time()
+
+    def add_turn(self, user_message: str, reply: str,
+                 max_turns: int = SESSION_HISTORY_TURNS, message_chars: int = SESSION_MESSAGE_CHARS,
+                 summary_chars: int = SESSION_SUMMARY_CHARS):
+        self.turns.append([_truncate(user_message, message_chars), _truncate(reply, message_chars)])
+        while len(self.turns) > max_turns:
+            user, bot = self.turns.pop(0)
+            item = f"کاربر: {_first_sentence(user, SESSION_SUMMARY_ITEM_CHARS)} / ربات: {_first_sentence(bot, SESSION_SUMMARY_ITEM_CHARS)}"
+            summary = f"{self.summary}\n{item}" if self.summary else item
+            # Keep the most recent part of the summary within its cap
+            while len(summary) > summary_chars and "\n" in summary:
+                summary = summary.split("\n", 1)[1]
+            self.summary = summary[-summary_chars:]
+        self.updated = time.time()
+
+    def context(self) -> str:
+        """The conversation so far, formatted for a prompt. Empty for a new chat."""
+        lines = []
+        if self.summary:
+            lines.append("خلاصه گفتگوی قبلی:")
+            lines.append(self.summary)
+        for user, bot in self.turns:
+            lines.append(f"کاربر: {user}")
+            lines.append(f"ربات: {bot}")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "phone_number": self.phone_number,
+            "info_collected": self.info_collected,
+            "turns": self.turns,
+            "summary": self.summary,
+            "updated": self.updated,
+        }
+
+    @classmethod
+    def from_dict(cls, chat_id: str, data: dict) -> "Session":
+        session = cls(chat_id)
+        session.name = data.get("name")
+        session.phone_number = data.get("phone_number")
+        session.info_collected = data.get("info_collected", False)
+        session.turns = data.get("turns", [])
+        session.summary = data.get("summary", "")
+        session.updated = data.get("updated", session.updated)
+        return session
+
+
+class SQLiteSessionBackend:
+    """Shared session table in a WAL-mode SQLite file."""
+
+    def __init__(self, path: str = SESSION_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def updated(self, chat_id: str):
+        row = self._connect().execute("SELECT updated FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, chat_id: str):
+        row = self._connect().execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return Session.from_dict(chat_id, json.loads(row[0])) if row else None
+
+    def save(self, session: Session):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (chat_id, data, updated) VALUES (?, ?, ?)",
+                (session.chat_id, json.dumps(session.to_dict(), ensure_ascii=False), session.updated)
+            )
+
+    def purge(self, before: float):
+        conn = self._connect()
+        with conn:
+            return conn.execute("DELETE FROM sessions WHERE updated < ?", (before,)).rowcount
+
+
+class SessionStore:
+    """LRU/TTL-bounded sessions by chat_id, optionally written through to a shared backend."""
+
+    PURGE_EVERY = 500  # Backend saves between purges of expired rows
+
+    def __init__(self, backend=None, max_sessions: int = SESSION_MAX_SESSIONS, ttl: float = SESSION_TTL):
+        if backend is None and SESSION_BACKEND == "sqlite":
+            backend = SQLiteSessionBackend()
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # chat_id -> Session, least recently used first
+        self._lock = threading.Lock()
+        self._saves = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, chat_id: str) -> Session:
+        """Returns the chat's session, starting a new one if there is none or it expired."""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is not None and now - session.updated > self.ttl:
+                del self._sessions[chat_id]
+                session = None
+        if self.backend is not None:
+            # Another worker may have moved the conversation on since we cached it.
+            updated = self.backend.updated(chat_id)
+            if updated is not None and (session is None or updated > session.updated):
+                session = self.backend.load(chat_id)
+        if session is None or now - session.updated > self.ttl:
+            self.misses += 1
+            session = Session(chat_id)
+        else:
+            self.hits += 1
+        self._remember(session)
+        return session
+
+    def save(self, session: Session):
+        self._remember(session)
+        if self.backend is not None:
+            self.backend.save(session)
+            self._saves += 1
+            if self._saves % self.PURGE_EVERY == 0:
+                self.backend.purge(time.time() - self.ttl)
+
+    def _remember(self, session: Session):
+        with self._lock:
+            self._sessions[session.chat_id] = session
+            self._sessions.move_to_end(session.chat_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,42 @@
+# =================================================================
+# streaming.py
+# Splits a streamed LLM answer into sentence- or paragraph-sized
+# segments, so each one can be delivered to Goftino as soon as it is
+# complete instead of waiting for the whole answer.
+# =================================================================
+import os
+import re
+
+STREAM_SEGMENT = os.environ.get("STREAM_SEGMENT", "sentence")         # "sentence" or "paragraph"
+STREAM_MIN_SEGMENT = int(os.environ.get("STREAM_MIN_SEGMENT", 80))    # Shorter pieces are merged with the next one
+
+_SENTENCE_END = re.compile(r"(?:[.!?؟…]+[\"')»]*\s+|\n+)")
+_PARAGRAPH_END = re.compile(r"\n\s*\n")
+
+
+class TextSegmenter:
+    """Buffers streamed tokens and emits complete segments."""
+
+    def __init__(self, mode: str = STREAM_SEGMENT, min_length: int = STREAM_MIN_SEGMENT):
+        self.boundary = _PARAGRAPH_END if mode == "paragraph" else _SENTENCE_END
+        self.min_length = min_length
+        self._buffer = ""
+
+    def feed(self, text: str):
+        """Adds streamed text and returns the segments it completed."""
+        self._buffer += text
+        segments = []
+        start = 0
+        for match in self.boundary.finditer(self._buffer):
+            if match.end() - start >= self.min_length:
+                segment = self._buffer[start:match.end()].strip()
+                if segment:
+                    segments.append(segment)
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        return segments
+
+    def flush(self):
+        """Returns whatever is left once the stream has ended."""
+        segment, self._buffer = self._buffer.strip(), ""
+        return [segment] if segment else []
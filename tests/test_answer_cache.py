@@ -0,0 +1,85 @@
+import numpy as np
+
+from answer_cache import AnswerCache
+
+
+def unit(*values):
+    return np.array(values, dtype=np.float32)
+
+
+def test_exact_hit_ignores_case_and_punctuation():
+    cache = AnswerCache()
+    cache.put("شهریه آیلتس چقدره؟", "faq", "answer")
+    assert cache.get("شهریه  آیلتس چقدره", "faq") == "answer"
+    assert cache.get("شهریه آیلتس چقدره", "greeting") is None
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("answer_cache.time.monotonic", lambda: now[0])
+    cache = AnswerCache(ttl=60)
+    cache.put("q", "faq", "answer", unit(1, 0))
+    now[0] += 30
+    assert cache.get("q", "faq") == "answer"
+    now[0] += 60
+    assert cache.get("q", "faq") is None
+    assert cache.get("other", "faq", unit(1, 0)) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = AnswerCache(max_entries=2)
+    cache.put("a", "faq", "A")
+    cache.put("b", "faq", "B")
+    assert cache.get("a", "faq") == "A"  # b is now the oldest
+    cache.put("c", "faq", "C")
+    assert cache.get("b", "faq") is None
+    assert cache.get("a", "faq") == "A"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_memory_cap_evicts():
+    cache = AnswerCache(max_mb=100 / (1024 * 1024))
+    cache.put("a", "faq", "x" * 60)
+    cache.put("b", "faq", "y" * 60)
+    assert cache.get("a", "faq") is None
+    assert cache.stats()["bytes"] <= 100
+
+
+def test_semantic_lookup_respects_threshold_and_intent():
+    cache = AnswerCache(similarity=0.95)
+    cache.put("address", "faq", "near", unit(1, 0, 0))
+    cache.put("hello", "greeting", "hi", unit(0, 1, 0))
+    assert cache.get("where is it", "faq", unit(0.99, 0.05, 0)) == "near"
+    assert cache.get("something else", "faq", unit(0.5, 0.5, 0.7)) is None
+    assert cache.get("hey", "faq", unit(0, 1, 0)) is None
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_evicted_slots_are_reused_for_new_vectors():
+    cache = AnswerCache(max_entries=2)
+    cache.put("a", "faq", "A", unit(1, 0, 0))
+    cache.put("b", "faq", "B", unit(0, 1, 0))
+    cache.put("c", "faq", "C", unit(0, 0, 1))
+    assert cache.get("x", "faq", unit(1, 0, 0)) is None
+    assert cache.get("y", "faq", unit(0, 0, 1)) == "C"
+    assert cache.get("z", "faq", unit(0, 1, 0)) == "B"
+
+
+def test_invalidate_drops_everything():
+    cache = AnswerCache()
+    cache.put("a", "faq", "A", unit(1, 0))
+    cache.invalidate()
+    assert cache.get("a", "faq", unit(1, 0)) is None
+    cache.put("b", "faq", "B", unit(0, 1))
+    assert cache.get("c", "faq", unit(0, 1)) == "B"
+
+
+def test_peek_does_not_count_misses():
+    cache = AnswerCache()
+    assert cache.peek("a", "faq") is None
+    assert cache.get("a", "faq") is None
+    cache.put("a", "faq", "A")
+    assert cache.peek("a", "faq") == "A"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
@@ -0,0 +1,56 @@
+import asyncio
+
+from dedup import MessageDeduplicator, SQLiteSeenBackend, message_key
+
+
+def test_message_key_prefers_the_message_id():
+    assert message_key({"message_id": "m1", "content": "hi"}) == "id:m1"
+    stamped = {"chat_id": "c", "date": "1700000000", "content": "hi"}
+    assert message_key(stamped) == message_key(dict(stamped))
+    assert message_key(stamped) != message_key(dict(stamped, date="1700000001"))
+
+
+def test_message_without_identity_is_never_a_duplicate():
+    dedup = MessageDeduplicator(window=600)
+    key = message_key({"chat_id": "c", "content": "بله"})
+    assert key is None
+    assert not dedup.seen(key)
+    assert not dedup.seen(key)
+
+
+def test_window_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("dedup.time.time", lambda: now[0])
+    dedup = MessageDeduplicator(window=10)
+    assert not dedup.seen("id:1")
+    now[0] += 5
+    assert dedup.seen("id:1")
+    now[0] += 20
+    assert not dedup.seen("id:1")
+    assert dedup.stats()["duplicates"] == 1
+
+
+def test_oldest_entries_are_evicted_past_max_entries():
+    dedup = MessageDeduplicator(window=600, max_entries=3)
+    for i in range(5):
+        dedup.seen(f"id:{i}")
+    assert dedup.stats()["entries"] == 3
+    assert not dedup.seen("id:0")
+    assert dedup.seen("id:4")
+
+
+def test_sqlite_claim_is_shared_between_deduplicators(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    first = MessageDeduplicator(backend=SQLiteSeenBackend(path), window=10)
+    second = MessageDeduplicator(backend=SQLiteSeenBackend(path), window=10)
+    assert not first.seen("id:1")
+    assert second.seen("id:1")
+    assert asyncio.run(second.aseen("id:1"))
+    assert not asyncio.run(second.aseen("id:2"))
+
+
+def test_sqlite_claim_takes_over_expired_keys(tmp_path):
+    backend = SQLiteSeenBackend(str(tmp_path / "dedup.db"))
+    assert backend.claim("id:1", now=100.0, window=10)
+    assert not backend.claim("id:1", now=105.0, window=10)
+    assert backend.claim("id:1", now=120.0, window=10)
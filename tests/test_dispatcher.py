@@ -0,0 +1,163 @@
+import asyncio
+
+from dispatcher import ChatDispatcher
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_busy_chat_is_deferred_without_blocking_other_chats():
+    async def scenario():
+        release = asyncio.Event()
+        log = []
+
+        async def handler(chat_id, message):
+            log.append(("start", chat_id, message))
+            if message == "a1":
+                await release.wait()
+            log.append(("end", chat_id, message))
+
+        dispatcher = ChatDispatcher(handler, workers=2, queue_size=10)
+        await dispatcher.start()
+        dispatcher.submit("a", "a1")
+        await settle()
+        dispatcher.submit("a", "a2")
+        dispatcher.submit("b", "b1")
+        await settle()
+        # a2 waits for a1, but b1 has already run on the other worker
+        assert ("end", "b", "b1") in log
+        assert ("start", "a", "a2") not in log
+        assert dispatcher.stats()["deferred"] == 1
+        release.set()
+        await dispatcher.stop()
+        return log
+
+    log = run(scenario())
+    assert log.index(("end", "a", "a1")) < log.index(("start", "a", "a2"))
+    assert log[-1] == ("end", "a", "a2")
+
+
+def test_runs_of_one_chat_never_overlap():
+    async def scenario():
+        active = {"a": 0}
+        peak = []
+
+        async def handler(chat_id, message):
+            active[chat_id] += 1
+            peak.append(active[chat_id])
+            await asyncio.sleep(0.01)
+            active[chat_id] -= 1
+
+        dispatcher = ChatDispatcher(handler, workers=4, queue_size=10, coalesce_max_messages=1)
+        await dispatcher.start()
+        for i in range(5):
+            dispatcher.submit("a", str(i))
+        await dispatcher.stop()
+        return peak
+
+    peak = run(scenario())
+    assert len(peak) == 5
+    assert max(peak) == 1
+
+
+def test_full_queue_sheds():
+    async def scenario():
+        async def handler(chat_id, message):
+            pass
+
+        dispatcher = ChatDispatcher(handler, workers=1, queue_size=2)
+        await dispatcher.start()
+        accepted = [dispatcher.submit(str(i), "hi") for i in range(4)]
+        stats = dispatcher.stats()
+        await dispatcher.stop()
+        return accepted, stats
+
+    accepted, stats = run(scenario())
+    assert accepted == [True, True, False, False]
+    assert stats["shed"] == 2
+
+
+def test_messages_for_a_queued_run_are_coalesced():
+    async def scenario():
+        received = []
+
+        async def handler(chat_id, message):
+            received.append(message)
+
+        dispatcher = ChatDispatcher(handler, workers=1, queue_size=10)
+        await dispatcher.start()
+        for text in ("سلام", "شهریه", "چقدره؟"):
+            dispatcher.submit("a", text)
+        stats = dispatcher.stats()
+        await dispatcher.stop()
+        return received, stats
+
+    received, stats = run(scenario())
+    assert received == ["سلام\nشهریه\nچقدره؟"]
+    assert stats["coalesced"] == 2
+    assert stats["queued"] == 1
+
+
+def test_coalesced_runs_are_capped_and_respect_the_queue_size():
+    async def scenario():
+        received = []
+
+        async def handler(chat_id, message):
+            received.append(message)
+
+        dispatcher = ChatDispatcher(handler, workers=1, queue_size=2, coalesce_max_messages=3,
+                                    coalesce_max_chars=100)
+        await dispatcher.start()
+        accepted = [dispatcher.submit("a", "x" * 10) for _ in range(10)]
+        stats = dispatcher.stats()
+        await dispatcher.stop()
+        return accepted, received, stats
+
+    accepted, received, stats = run(scenario())
+    # Two runs of three messages fill the queue; the rest is shed
+    assert accepted.count(True) == 6
+    assert stats["shed"] == 4
+    assert received == ["\n".join(["x" * 10] * 3)] * 2
+
+
+def test_character_cap_starts_a_new_run():
+    async def scenario():
+        received = []
+
+        async def handler(chat_id, message):
+            received.append(message)
+
+        dispatcher = ChatDispatcher(handler, workers=1, queue_size=10, coalesce_max_chars=15)
+        await dispatcher.start()
+        for text in ("a" * 10, "b" * 5, "c" * 5):
+            dispatcher.submit("a", text)
+        await dispatcher.stop()
+        return received
+
+    assert run(scenario()) == ["a" * 10 + "\n" + "b" * 5, "c" * 5]
+
+
+def test_coalesce_window_waits_for_the_burst_to_end():
+    async def scenario():
+        received = []
+
+        async def handler(chat_id, message):
+            received.append(message)
+
+        dispatcher = ChatDispatcher(handler, workers=1, queue_size=10, coalesce_window=0.05)
+        await dispatcher.start()
+        dispatcher.submit("a", "1")
+        await asyncio.sleep(0.02)
+        dispatcher.submit("a", "2")
+        await asyncio.sleep(0.1)
+        dispatcher.submit("a", "3")
+        await dispatcher.stop()
+        return received
+
+    assert run(scenario()) == ["1\n2", "3"]
@@ -0,0 +1,88 @@
+import asyncio
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+from embedding_store import CachedEmbeddings, EmbeddingStore, embedding_key
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += len(texts)
+        return [[float(len(t)), 1.0, 0.5] for t in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        return [float(len(text)), 2.0, 0.5]
+
+
+def test_vectors_persist_across_instances(tmp_path):
+    store = EmbeddingStore("m", path=str(tmp_path))
+    store.put_many(["a", "b"], [[1, 2, 3], [4, 5, 6]])
+    reopened = EmbeddingStore("m", path=str(tmp_path))
+    a, b, c = reopened.get_many(["a", "b", "c"])
+    np.testing.assert_array_equal(a, [1, 2, 3])
+    np.testing.assert_array_equal(b, [4, 5, 6])
+    assert c is None
+    assert len(reopened) == 2
+
+
+def test_rows_appended_by_another_writer_are_picked_up(tmp_path):
+    reader = EmbeddingStore("m", path=str(tmp_path))
+    writer = EmbeddingStore("m", path=str(tmp_path))
+    writer.put_many(["a"], [[1, 2, 3]])
+    np.testing.assert_array_equal(reader.get_many(["a"])[0], [1, 2, 3])
+
+
+def test_partial_rows_of_a_dead_writer_are_truncated(tmp_path):
+    store = EmbeddingStore("m", path=str(tmp_path))
+    store.put_many(["a"], [[1, 2, 3]])
+    # A writer that died after writing vector bytes but before its keys
+    with open(store._vectors_path, "ab") as f:
+        f.write(np.array([9, 9], dtype=np.float32).tobytes())
+    with open(store._keys_path, "a", encoding="ascii") as f:
+        f.write("partial-key-without-newline")
+    store = EmbeddingStore("m", path=str(tmp_path))
+    assert len(store) == 1
+    store.put_many(["b"], [[4, 5, 6]])
+    reopened = EmbeddingStore("m", path=str(tmp_path))
+    np.testing.assert_array_equal(reopened.get_many(["b"])[0], [4, 5, 6])
+    np.testing.assert_array_equal(reopened.get_many(["a"])[0], [1, 2, 3])
+
+
+def test_dimension_mismatch_is_rejected(tmp_path):
+    store = EmbeddingStore("m", path=str(tmp_path))
+    store.put_many(["a"], [[1, 2, 3]])
+    with pytest.raises(ValueError):
+        store.put_many(["b"], [[1, 2]])
+
+
+def test_float16_store(tmp_path):
+    store = EmbeddingStore("m", path=str(tmp_path), dtype="float16")
+    store.put_many(["a"], [[0.5, 0.25, 1.0]])
+    np.testing.assert_allclose(EmbeddingStore("m", path=str(tmp_path), dtype="float16").get_many(["a"])[0],
+                               [0.5, 0.25, 1.0])
+
+
+def test_documents_are_embedded_once_and_queries_stay_in_memory(tmp_path):
+    inner = CountingEmbeddings()
+    store = EmbeddingStore("m", path=str(tmp_path))
+    cached = CachedEmbeddings(inner, "m", store=store, query_cache_size=2)
+    first = cached.embed_documents(["x", "yy"])
+    assert cached.embed_documents(["yy", "x"]) == first[::-1]
+    assert asyncio.run(cached.aembed_documents(["x"])) == first[:1]
+    assert inner.calls == 2
+    assert len(store) == 2
+
+    cached.embed_query("q1")
+    cached.embed_query("q1")
+    asyncio.run(cached.aembed_query("q2"))
+    cached.embed_query("q3")
+    assert inner.calls == 5
+    assert store.get_many([embedding_key("m", "q1")]) == [None]
+    cached.embed_query("q1")  # evicted from the two-entry LRU
+    assert inner.calls == 6
@@ -0,0 +1,206 @@
+# =================================================================
+# vector_index.py
+# FAISS index modes for the knowledge base. embedder.py builds a flat,
+# HNSW or IVF-PQ index (optionally after PCA dimension reduction) and
+# chatbot.py loads it memory-mapped with the configured search
+# parameters. The report command compares the approximate modes
+# against the exact flat baseline on the current corpus.
+#
+# Usage:
+#   python vector_index.py report --reduce-dim 0 256 --nprobe 4 16
+# =================================================================
+import argparse
+import math
+import os
+import pickle
+import time
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+INDEX_MODE = os.environ.get("INDEX_MODE", "flat")                  # "flat", "hnsw" or "ivfpq"
+INDEX_REDUCE_DIM = int(os.environ.get("INDEX_REDUCE_DIM", 0))      # PCA target dimension, 0 keeps all 3072
+INDEX_HNSW_M = int(os.environ.get("INDEX_HNSW_M", 32))             # Graph neighbours per node
+INDEX_IVF_NLIST = int(os.environ.get("INDEX_IVF_NLIST", 0))        # Inverted lists, 0 picks ~4*sqrt(n)
+INDEX_PQ_M = int(os.environ.get("INDEX_PQ_M", 64))                 # PQ sub-quantizers, must divide the dimension
+INDEX_MMAP = os.environ.get("INDEX_MMAP", "1") == "1"
+INDEX_NPROBE = int(os.environ.get("INDEX_NPROBE", 16))             # IVF lists searched per query
+INDEX_EF_SEARCH = int(os.environ.get("INDEX_EF_SEARCH", 64))       # HNSW candidate list size
+RETRIEVER_K = int(os.environ.get("RETRIEVER_K", 4))                # Documents returned per query
+
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "index.pkl"
+
+
+# =================================================================
+# 1. BUILD
+# =================================================================
+def factory_string(mode: str, n_vectors: int, dim: int, reduce_dim: int = INDEX_REDUCE_DIM,
+                   hnsw_m: int = INDEX_HNSW_M, nlist: int = INDEX_IVF_NLIST, pq_m: int = INDEX_PQ_M) -> str:
+    """Returns the faiss.index_factory description for an index mode."""
+    prefix = ""
+    if reduce_dim and reduce_dim < dim:
+        prefix = f"PCAR{reduce_dim},"
+        dim = reduce_dim
+    if mode == "flat":
+        return prefix + "Flat"
+    if mode == "hnsw":
+        return prefix + f"HNSW{hnsw_m},Flat"
+    if mode == "ivfpq":
+        nlist = nlist or max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+        if dim % pq_m:
+            raise ValueError(f"INDEX_PQ_M={pq_m} must divide the index dimension {dim}")
+        # 8-bit codes need ~10k training vectors; small corpora get 4-bit codes.
+        nbits = 8 if n_vectors >= 256 * 39 else 4
+        return prefix + f"IVF{nlist},PQ{pq_m}x{nbits}"
+    raise ValueError(f"Unknown index mode: {mode}")
+
+
+def build_faiss_index(vectors, description: str):
+    """Creates, trains and fills a FAISS index from a float32 matrix."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index = faiss.index_factory(vectors.shape[1], description)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def build_vectorstore(texts, vectors, metadatas, ids, embeddings, description: str) -> FAISS:
+    """Builds a langchain FAISS store around an index of the given description."""
+    index = build_faiss_index(vectors, description)
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=metadata)
+        for doc_id, text, metadata in zip(ids, texts, metadatas)
+    })
+    return FAISS(embeddings, index, docstore, dict(enumerate(ids)))
+
+
+# =================================================================
+# 2. LOAD
+# =================================================================
+def set_search_parameters(index, nprobe: int = INDEX_NPROBE, ef_search: int = INDEX_EF_SEARCH):
+    """Applies nprobe / efSearch where the index type supports them."""
+    space = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        try:
+            space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass  # Not an IVF / HNSW index
+
+
+def _mmap_flags():
+    """IO flags to try, best first. IO_FLAG_MMAP only maps IVF inverted lists;
+    IO_FLAG_MMAP_IFC (faiss >= 1.8) also maps flat and HNSW vector storage."""
+    flags = []
+    if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        flags.append(faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    flags.append(faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    return flags
+
+
+def read_index(path: str, mmap: bool = INDEX_MMAP):
+    """Reads index.faiss, memory-mapped when possible."""
+    index_path = os.path.join(path, INDEX_FILE)
+    if mmap:
+        for flags in _mmap_flags():
+            try:
+                return faiss.read_index(index_path, flags)
+            except RuntimeError:
+                pass  # Index type or faiss build without support for this kind of mapping
+    return faiss.read_index(index_path)
+
+
+def load_vectorstore(path: str, embeddings, mmap: bool = INDEX_MMAP,
+                     nprobe: int = INDEX_NPROBE, ef_search: int = INDEX_EF_SEARCH) -> FAISS:
+    """Loads a FAISS store saved by embedder.py with the configured search settings."""
+    index = read_index(path, mmap)
+    set_search_parameters(index, nprobe, ef_search)
+    with open(os.path.join(path, DOCSTORE_FILE), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+# =================================================================
+# 3. RECALL / LATENCY REPORT
+# =================================================================
+def corpus_vectors(path: str):
+    """Returns the corpus embeddings of a saved index from the embedding store."""
+    from embedding_store import EmbeddingStore, embedding_key
+    from embedder import EMBEDDING_MODEL
+
+    with open(os.path.join(path, DOCSTORE_FILE), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    texts = [docstore.search(index_to_docstore_id[i]).page_content for i in range(len(index_to_docstore_id))]
+    vectors = EmbeddingStore(EMBEDDING_MODEL).get_many([embedding_key(EMBEDDING_MODEL, t) for t in texts])
+    if any(v is None for v in vectors):
+        # Fall back to the index itself, which only works for flat storage.
+        return read_index(path, mmap=False).reconstruct_n(0, len(texts))
+    return np.stack(vectors)
+
+
+def _search_timed(index, queries, k):
+    start = time.perf_counter()
+    _, ids = index.search(queries, k)
+    return ids, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def report(path: str, modes, reduce_dims, nprobes, ef_searches, k: int, n_queries: int, noise: float):
+    """Prints recall@k and latency of each configuration against exact flat search.
+
+    Queries are corpus vectors with Gaussian noise added, so the report
+    needs no network access.
+    """
+    vectors = corpus_vectors(path).astype(np.float32)
+    n, dim = vectors.shape
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(n, size=min(n_queries, n), replace=False)]
+    queries = queries + rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+
+    baseline = build_faiss_index(vectors, "Flat")
+    truth, flat_ms = _search_timed(baseline, queries, k)
+    print(f"Corpus: {n} vectors x {dim} dims, {len(queries)} queries, k={k}")
+    print(f"{'index':<32} {'params':<14} {'recall@k':>9} {'ms/query':>9} {'MB':>8}")
+    print(f"{'Flat':<32} {'-':<14} {1.0:>9.3f} {flat_ms:>9.3f} {vectors.nbytes / 2**20:>8.1f}")
+
+    for mode in modes:
+        if mode == "flat":
+            continue
+        for reduce_dim in reduce_dims:
+            if reduce_dim >= dim:
+                continue
+            try:
+                description = factory_string(mode, n, dim, reduce_dim)
+                index = build_faiss_index(vectors, description)
+            except (ValueError, RuntimeError) as e:
+                print(f"{mode} reduce_dim={reduce_dim}: skipped ({e})")
+                continue
+            size_mb = faiss.serialize_index(index).nbytes / 2**20
+            settings = [("nprobe", v) for v in nprobes] if mode == "ivfpq" else [("efSearch", v) for v in ef_searches]
+            for name, value in settings:
+                faiss.ParameterSpace().set_index_parameter(index, name, value)
+                ids, ms = _search_timed(index, queries, k)
+                recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(ids, truth)])
+                print(f"{description:<32} {f'{name}={value}':<14} {recall:>9.3f} {ms:>9.3f} {size_mb:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FAISS index modes against the flat baseline.")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("--path", default="faiss_index")
+    parser.add_argument("--modes", nargs="+", default=["hnsw", "ivfpq"])
+    parser.add_argument("--reduce-dim", nargs="+", type=int, default=[0, 256])
+    parser.add_argument("--nprobe", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--ef-search", nargs="+", type=int, default=[16, 64, 128])
+    parser.add_argument("--k", type=int, default=RETRIEVER_K)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.01)
+    args = parser.parse_args()
+    report(args.path, args.modes, args.reduce_dim, args.nprobe, args.ef_search, args.k, args.queries, args.noise)
+
+
+if __name__ == "__main__":
+    main()